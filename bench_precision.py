@@ -0,0 +1,73 @@
+import argparse
+import itertools
+import os
+import pickle
+import time
+
+import torch
+import yaml
+
+from main_model import CSDI_Physio
+from dataset_physio import get_dataloader
+from utils import evaluate
+
+# inference speed and CRPS drift of reduced precision against fp32 on the
+# pretrained physio model (CPU by default)
+
+parser = argparse.ArgumentParser(description="CSDI")
+parser.add_argument("--config", type=str, default="base.yaml")
+parser.add_argument("--device", default="cpu")
+parser.add_argument("--seed", type=int, default=1)
+parser.add_argument("--testmissingratio", type=float, default=0.1)
+parser.add_argument("--nfold", type=int, default=0)
+parser.add_argument("--modelfolder", type=str, default="pretrained")
+parser.add_argument("--nsample", type=int, default=10)
+parser.add_argument("--nbatch", type=int, default=4)
+parser.add_argument("--precisions", type=str, nargs="+", default=["fp32", "bf16"])
+args = parser.parse_args()
+
+with open("config/" + args.config, "r") as f:
+    config = yaml.safe_load(f)
+config["model"]["is_unconditional"] = False
+config["model"]["test_missing_ratio"] = args.testmissingratio
+
+_, _, test_loader = get_dataloader(
+    seed=args.seed,
+    nfold=args.nfold,
+    batch_size=config["train"]["batch_size"],
+    missing_ratio=args.testmissingratio,
+)
+test_batches = list(itertools.islice(test_loader, args.nbatch))
+
+model = CSDI_Physio(config, args.device).to(args.device)
+model.load_state_dict(
+    torch.load("./save/" + args.modelfolder + "/model.pth", map_location=args.device)
+)
+
+foldername = "./save/bench_precision/"
+os.makedirs(foldername, exist_ok=True)
+results = {}
+for precision in args.precisions:
+    torch.manual_seed(args.seed)
+    start = time.perf_counter()
+    evaluate(
+        model,
+        test_batches,
+        nsample=args.nsample,
+        foldername=foldername,
+        precision=precision,
+    )
+    elapsed = time.perf_counter() - start
+    with open(foldername + "result_nsample" + str(args.nsample) + ".pk", "rb") as f:
+        rmse, mae, crps = pickle.load(f)
+    results[precision] = (elapsed, crps)
+
+base_time, base_crps = results[args.precisions[0]]
+for precision, (elapsed, crps) in results.items():
+    print(
+        precision,
+        "time: %.2fs" % elapsed,
+        "speedup: %.2fx" % (base_time / elapsed),
+        "CRPS: %.5f" % crps,
+        "drift: %+.5f" % (crps - base_crps),
+    )
@@ -0,0 +1,80 @@
+import argparse
+import itertools
+import os
+import pickle
+import time
+
+import torch
+import yaml
+
+from main_model import CSDI_Physio
+from dataset_physio import get_dataloader
+from diffusion_sampler import DDIMImputer
+from utils import evaluate
+
+# wall time and CRPS of the DDIM sampler against its step count on the
+# pretrained physio model, next to the model's own 50-step ancestral sampler
+# ("ddpm")
+
+parser = argparse.ArgumentParser(description="CSDI")
+parser.add_argument("--config", type=str, default="base.yaml")
+parser.add_argument("--device", default="cpu")
+parser.add_argument("--seed", type=int, default=1)
+parser.add_argument("--testmissingratio", type=float, default=0.1)
+parser.add_argument("--nfold", type=int, default=0)
+parser.add_argument("--modelfolder", type=str, default="pretrained")
+parser.add_argument("--nsample", type=int, default=10)
+parser.add_argument("--nbatch", type=int, default=4)
+parser.add_argument("--eta", type=float, default=0.0)
+parser.add_argument(
+    "--samplesteps", type=str, nargs="+", default=["ddpm", "50", "20", "10", "5"]
+)
+args = parser.parse_args()
+
+with open("config/" + args.config, "r") as f:
+    config = yaml.safe_load(f)
+config["model"]["is_unconditional"] = False
+config["model"]["test_missing_ratio"] = args.testmissingratio
+
+_, _, test_loader = get_dataloader(
+    seed=args.seed,
+    nfold=args.nfold,
+    batch_size=config["train"]["batch_size"],
+    missing_ratio=args.testmissingratio,
+)
+test_batches = list(itertools.islice(test_loader, args.nbatch))
+
+model = CSDI_Physio(config, args.device).to(args.device)
+model.load_state_dict(
+    torch.load("./save/" + args.modelfolder + "/model.pth", map_location=args.device)
+)
+
+foldername = "./save/bench_sampler/"
+os.makedirs(foldername, exist_ok=True)
+results = {}
+for steps in args.samplesteps:
+    eval_model = model
+    if steps != "ddpm":
+        eval_model = DDIMImputer(model, config, int(steps), args.eta)
+    start = time.perf_counter()
+    evaluate(
+        eval_model,
+        test_batches,
+        nsample=args.nsample,
+        foldername=foldername,
+        seed=args.seed,
+    )
+    elapsed = time.perf_counter() - start
+    with open(foldername + "result_nsample" + str(args.nsample) + ".pk", "rb") as f:
+        rmse, mae, crps = pickle.load(f)
+    results[steps] = (elapsed, crps)
+
+base_time, base_crps = results[args.samplesteps[0]]
+for steps, (elapsed, crps) in results.items():
+    print(
+        "steps:", steps,
+        "time: %.2fs" % elapsed,
+        "speedup: %.2fx" % (base_time / elapsed),
+        "CRPS: %.5f" % crps,
+        "drift: %+.5f" % (crps - base_crps),
+    )
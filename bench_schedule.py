@@ -0,0 +1,70 @@
+import argparse
+import time
+
+import numpy as np
+import torch
+import yaml
+
+from diffusion_sampler import DiffusionSchedule, get_beta_schedule
+
+# per-step overhead of the reverse update with an identity denoiser: schedule
+# coefficients taken from numpy (and the step index built on the host) against
+# the device-resident DiffusionSchedule buffers
+
+parser = argparse.ArgumentParser(description="CSDI")
+parser.add_argument("--config", type=str, default="base.yaml")
+parser.add_argument("--device", default="cpu")
+parser.add_argument("--batch_size", type=int, default=16)
+parser.add_argument("--repeat", type=int, default=20)
+args = parser.parse_args()
+
+with open("config/" + args.config, "r") as f:
+    config = yaml.safe_load(f)
+config_diff = config["diffusion"]
+num_steps = config_diff["num_steps"]
+device = torch.device(args.device)
+shape = (args.batch_size, 35, 48)
+
+beta = get_beta_schedule(config_diff)
+alpha_hat = 1 - beta
+alpha = np.cumprod(alpha_hat)
+schedule = DiffusionSchedule(config_diff).to(device)
+
+
+def numpy_loop(x):
+    for t in range(num_steps - 1, -1, -1):
+        step = torch.tensor([t]).to(device)
+        predicted = x + step  # stands in for the denoiser
+        coeff1 = 1 / alpha_hat[t] ** 0.5
+        coeff2 = (1 - alpha_hat[t]) / (1 - alpha[t]) ** 0.5
+        x = coeff1 * (x - coeff2 * predicted)
+        if t > 0:
+            sigma = ((1.0 - alpha[t - 1]) / (1.0 - alpha[t]) * beta[t]) ** 0.5
+            x += sigma * torch.randn_like(x)
+    return x
+
+
+def buffer_loop(x):
+    for t in range(num_steps - 1, -1, -1):
+        step = schedule.steps[t : t + 1]
+        predicted = x + step
+        x = schedule.ddpm_step(x, predicted, t)
+    return x
+
+
+def timeit(loop):
+    x = torch.randn(shape, device=device)
+    loop(x)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        loop(x)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / (args.repeat * num_steps) * 1e6
+
+
+with torch.no_grad():
+    for name, loop in [("numpy", numpy_loop), ("buffers", buffer_loop)]:
+        print(name, "us/step:", timeit(loop))
@@ -0,0 +1,77 @@
+import argparse
+import time
+
+import torch
+import yaml
+
+from sparse_attention import count_flops, feature_tokens, get_sparse_trans, time_tokens
+
+# one residual block's time and feature attention on physio-shaped inputs
+# (B,35,48) at increasing missing ratios of the grid: the dense layer as in
+# diff_models, the masked fallback and the packed path. The active tokens are
+# the observed ones (conditional and target); --testmissingratio only moves
+# observed points from the conditional to the target set, so the sweep is over
+# the missing ratio of the grid itself (physio is about 0.8)
+
+parser = argparse.ArgumentParser(description="CSDI")
+parser.add_argument("--config", type=str, default="base.yaml")
+parser.add_argument("--device", default="cpu")
+parser.add_argument("--batch_size", type=int, default=16)
+parser.add_argument("--missingratios", type=str, default="0.0,0.5,0.8,0.9,0.95")
+parser.add_argument("--repeat", type=int, default=10)
+args = parser.parse_args()
+
+with open("config/" + args.config, "r") as f:
+    config = yaml.safe_load(f)
+config_diff = config["diffusion"]
+channels = config_diff["channels"]
+heads = config_diff["nheads"]
+device = torch.device(args.device)
+B, K, L = args.batch_size, 35, 48
+
+layers = {
+    mode: get_sparse_trans(heads, 1, channels, mode).to(device).eval()
+    for mode in ["packed", "masked"]
+}
+layers["masked"].load_state_dict(layers["packed"].state_dict())
+
+
+def dense(x, active):
+    encoder = layers["packed"].layer
+    return encoder(x.permute(2, 0, 1)).permute(1, 2, 0)
+
+
+def timeit(fn, x, active):
+    fn(x, active)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        fn(x, active)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / args.repeat * 1e3
+
+
+with torch.no_grad():
+    for ratio in [float(r) for r in args.missingratios.split(",")]:
+        active = torch.rand(B, K, L, device=device) >= ratio
+        for name, tokens, S in [
+            ("time", time_tokens(active), L),
+            ("feature", feature_tokens(active), K),
+        ]:
+            x = torch.randn(len(tokens), channels, S, device=device)
+            flops = count_flops(tokens, channels)
+            print(
+                "missing %.2f %-7s MFLOPs dense %8.1f sparse %8.1f | ms dense %7.2f"
+                " masked %7.2f packed %7.2f"
+                % (
+                    ratio,
+                    name,
+                    flops["dense"] / 1e6,
+                    flops["sparse"] / 1e6,
+                    timeit(dense, x, tokens),
+                    timeit(layers["masked"], x, tokens),
+                    timeit(layers["packed"], x, tokens),
+                )
+            )
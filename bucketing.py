@@ -0,0 +1,131 @@
+import numpy as np
+from torch.utils.data import Sampler
+from torch.utils.data._utils.collate import default_collate
+
+# batches of series with similar effective length (last observed timepoint
+# + 1) and equal K, padded only up to the longest series of the batch instead
+# of the full grid. The model sees the shorter L through the timepoints (time
+# embedding, side info) and the masks, which are zero on the padding.
+
+TIME_KEYS = ["observed_data", "observed_mask", "gt_mask", "hist_mask", "timepoints"]
+
+
+def get_effective_lengths(observed_masks, chunk_size=512):
+    # (N,L,K) masks (array or memmap) -> (N,) last observed timepoint + 1
+    lengths = np.zeros(len(observed_masks), dtype=np.int64)
+    for start in range(0, len(observed_masks), chunk_size):
+        observed = np.asarray(observed_masks[start : start + chunk_size]).any(2)
+        last = observed.shape[1] - np.argmax(observed[:, ::-1], axis=1)
+        lengths[start : start + chunk_size] = np.where(observed.any(1), last, 1)
+    return lengths
+
+
+class BucketBatchSampler(Sampler):
+    # indices sorted by (K, length) with random tie-breaking, cut into batches
+    # that never mix K, and the batch order shuffled per epoch. Under
+    # torch.distributed, shard() keeps every num_replicas-th batch; as in
+    # DistributedSampler every rank gets the same number of batches, the list
+    # is padded with repeated batches (or its tail dropped with drop_last)
+    def __init__(
+        self,
+        lengths,
+        batch_size,
+        num_features=None,
+        shuffle=True,
+        seed=0,
+        drop_last=False,
+        num_replicas=1,
+        rank=0,
+    ):
+        self.lengths = np.asarray(lengths)
+        if num_features is None:
+            num_features = np.zeros(len(self.lengths), dtype=np.int64)
+        self.num_features = np.asarray(num_features)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+
+    def shard(self, rank, num_replicas):
+        return BucketBatchSampler(
+            self.lengths,
+            self.batch_size,
+            self.num_features,
+            self.shuffle,
+            self.seed,
+            self.drop_last,
+            num_replicas,
+            rank,
+        )
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def get_batches(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+        tiebreak = rng.rand(len(self.lengths)) if self.shuffle else np.zeros(len(self.lengths))
+        order = np.lexsort((tiebreak, self.lengths, self.num_features))
+        batches = []
+        for k in np.unique(self.num_features):
+            group = order[self.num_features[order] == k]
+            for start in range(0, len(group), self.batch_size):
+                batch = group[start : start + self.batch_size]
+                if len(batch) == self.batch_size or not self.drop_last:
+                    batches.append(batch.tolist())
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        if self.num_replicas > 1:
+            if self.drop_last:
+                total = len(batches) // self.num_replicas * self.num_replicas
+                batches = batches[:total]
+            else:
+                total = -(-len(batches) // self.num_replicas) * self.num_replicas
+                while len(batches) < total:
+                    batches += batches[: total - len(batches)]
+        return batches[self.rank :: self.num_replicas]
+
+    def __iter__(self):
+        return iter(self.get_batches())
+
+    def __len__(self):
+        return len(self.get_batches())
+
+
+def get_padded_length(length, multiple=1):
+    return -(-length // multiple) * multiple
+
+
+def trim_collate(items, multiple=1):
+    # default_collate after cutting the time axis of every series to the
+    # longest effective length in the batch (rounded up to multiple)
+    length = 1
+    for item in items:
+        observed = np.asarray(item["observed_mask"]).any(1)
+        if observed.any():
+            length = max(length, len(observed) - int(np.argmax(observed[::-1])))
+    length = min(get_padded_length(length, multiple), len(items[0]["timepoints"]))
+    trimmed = []
+    for item in items:
+        item = dict(item)
+        for key in TIME_KEYS:
+            if key in item:
+                item[key] = item[key][:length]
+        trimmed.append(item)
+    return default_collate(trimmed)
+
+
+def report_tokens(batch_sampler, full_length, num_features, multiple=1):
+    # (series x time x feature) tokens per epoch with full-grid padding and
+    # with per-batch padding; num_features: K of the series (scalar or (N,))
+    lengths = batch_sampler.lengths
+    K = np.broadcast_to(np.asarray(num_features), lengths.shape)
+    full = 0
+    bucketed = 0
+    for batch in batch_sampler.get_batches():
+        length = min(get_padded_length(int(lengths[batch].max()), multiple), full_length)
+        full += int(len(batch) * full_length * K[batch[0]])
+        bucketed += int(len(batch) * length * K[batch[0]])
+    return {"tokens_full": full, "tokens_bucketed": bucketed}
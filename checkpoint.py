@@ -0,0 +1,105 @@
+import glob
+import os
+import random
+import threading
+
+import numpy as np
+import torch
+
+
+def to_cpu(obj):
+    # copy of a (nested) state dict with every tensor cloned to cpu, so the
+    # snapshot stays valid while training keeps updating the originals
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {key: to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(value) for value in obj)
+    return obj
+
+
+def get_rng_state():
+    state = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    # the generator states must be cpu byte tensors, whatever map_location the
+    # checkpoint was loaded with
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"].cpu())
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([s.cpu() for s in state["cuda"]])
+
+
+def atomic_save(obj, path):
+    tmp_path = path + ".tmp"
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+class Checkpointer:
+    # checkpoint_epoch{N}.pth files (the last keep_last are kept) plus
+    # checkpoint_best.pth; files are written atomically on a background thread.
+    # keep_last=0 keeps only checkpoint_best.pth
+    def __init__(self, folder, keep_last=3):
+        if keep_last < 0:
+            raise ValueError("keep_last must be non-negative: " + str(keep_last))
+        self.folder = folder
+        self.keep_last = keep_last
+        self.thread = None
+        self.error = None
+
+    def path(self, epoch):
+        return os.path.join(self.folder, "checkpoint_epoch" + str(epoch) + ".pth")
+
+    def best_path(self):
+        return os.path.join(self.folder, "checkpoint_best.pth")
+
+    def paths(self):
+        # epoch checkpoints, oldest first
+        paths = glob.glob(os.path.join(self.folder, "checkpoint_epoch*.pth"))
+        prefix = len("checkpoint_epoch")
+        return sorted(paths, key=lambda p: int(os.path.basename(p)[prefix:-4]))
+
+    def latest(self):
+        paths = self.paths()
+        return paths[-1] if paths else None
+
+    def save(self, state, epoch, is_best=False):
+        snapshot = to_cpu(state)  # taken now, written in the background
+        self.wait()
+        self.thread = threading.Thread(
+            target=self._write, args=(snapshot, epoch, is_best), daemon=True
+        )
+        self.thread.start()
+
+    def _write(self, snapshot, epoch, is_best):
+        try:
+            atomic_save(snapshot, self.path(epoch))
+            if is_best:
+                atomic_save(snapshot, self.best_path())
+            paths = self.paths()
+            for old_path in paths[: len(paths) - self.keep_last]:
+                os.remove(old_path)
+        except Exception as e:
+            self.error = e
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def load(self, path, device):
+        return torch.load(path, map_location=device, weights_only=False)
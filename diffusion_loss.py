@@ -0,0 +1,205 @@
+import numpy as np
+import torch
+import torch.nn as nn
+
+from diffusion_sampler import DiffusionSchedule, repeat_samples
+
+
+def sample_timesteps(batch_size, k, num_steps, device):
+    # (k,B) random diffusion steps, k per series
+    return torch.randint(0, num_steps, (k, batch_size), device=device)
+
+
+def get_stratified_steps(num_steps, n, seed=0):
+    # a fixed subset of n steps, one drawn uniformly from each of n contiguous
+    # strata, and the stratum weights; the weighted loss over the subset is an
+    # unbiased estimate of the mean loss over all steps
+    if not 1 <= n <= num_steps:
+        raise ValueError(
+            "the number of steps must be in [1, " + str(num_steps) + "]: " + str(n)
+        )
+    bounds = np.linspace(0, num_steps, n + 1).round().astype(int)
+    rng = np.random.RandomState(seed)
+    steps = [rng.randint(low, high) for low, high in zip(bounds[:-1], bounds[1:])]
+    weights = np.diff(bounds) / num_steps
+    return torch.tensor(steps), torch.tensor(weights, dtype=torch.float32)
+
+
+def calc_step_losses(
+    predict_noise, schedule, observed_data, cond_mask, observed_mask, t
+):
+    # (n,) loss of every diffusion step in t, see calc_loss_multistep
+    n, B = t.shape
+    t = t.reshape(n * B)
+    current_alpha = schedule.alpha[t].view(n * B, 1, 1)
+    observed_data = repeat_samples(observed_data, n)
+    noise = torch.randn_like(observed_data)
+    noisy_data = (current_alpha ** 0.5) * observed_data + (
+        1.0 - current_alpha
+    ) ** 0.5 * noise
+    predicted = predict_noise(noisy_data, t)  # (n*B,K,L)
+
+    target_mask = observed_mask - cond_mask
+    residual = (noise - predicted) * repeat_samples(target_mask, n)
+    num_eval = target_mask.sum()
+    return (residual ** 2).reshape(n, -1).sum(1) / (num_eval if num_eval > 0 else 1)
+
+
+def calc_loss_multistep(
+    predict_noise, schedule, observed_data, cond_mask, observed_mask, t
+):
+    # noise-prediction loss for n diffusion steps per series in one denoiser call.
+    # t: (n,B); the step axis is folded into the batch axis (sample-major, as in
+    # DDIMSampler.sample_batched), so predict_noise(noisy_data, t) sees (n*B,K,L)
+    # inputs and broadcasts its per-batch side info with repeat_samples.
+    # Equal to the mean of the single-step CSDI losses over the n steps
+    return calc_step_losses(
+        predict_noise, schedule, observed_data, cond_mask, observed_mask, t
+    ).mean()
+
+
+def calc_loss_valid_multistep(
+    predict_noise,
+    schedule,
+    observed_data,
+    cond_mask,
+    observed_mask,
+    chunk_size=None,
+    steps=None,
+    weights=None,
+):
+    # validation loss over all diffusion steps (or a fixed subset from
+    # get_stratified_steps with its weights), stacked into the batch axis
+    # chunk_size steps at a time
+    if steps is None:
+        steps = schedule.steps
+    steps = steps.to(observed_data.device)
+    if weights is None:
+        weights = torch.full((len(steps),), 1.0 / len(steps))
+    weights = weights.to(observed_data.device)
+    chunk_size = len(steps) if chunk_size is None else chunk_size
+    if chunk_size <= 0:
+        raise ValueError("chunk_size must be positive: " + str(chunk_size))
+    B = observed_data.shape[0]
+    loss = 0
+    for start in range(0, len(steps), chunk_size):
+        t = steps[start : start + chunk_size].unsqueeze(1).expand(-1, B)
+        step_losses = calc_step_losses(
+            predict_noise, schedule, observed_data, cond_mask, observed_mask, t
+        )
+        loss += (weights[start : start + chunk_size] * step_losses).sum()
+    return loss
+
+
+class MultistepLoss(nn.Module):
+    # forward(batch, is_train) as the wrapped CSDI model (CSDI_Physio,
+    # CSDI_PM25, CSDI_Forecasting), with the training loss over
+    # config["train"]["timesteps_per_series"] diffusion steps per series and
+    # the validation loss over all steps (or config["train"]["valid_steps"]
+    # stratified steps) in chunks of config["train"]["valid_chunk_size"]
+    # steps. The side info is built once per batch for all steps
+    def __init__(self, model, config):
+        super().__init__()
+        self.model = model
+        device = next(model.parameters()).device
+        self.schedule = DiffusionSchedule(config["diffusion"]).to(device)
+        train_config = config["train"]
+        self.k = train_config.get("timesteps_per_series", 1)
+        if self.k < 1:
+            raise ValueError("timesteps_per_series must be positive: " + str(self.k))
+        self.valid_chunk_size = train_config.get("valid_chunk_size", 1)
+        self.valid_steps, self.valid_weights = None, None
+        if train_config.get("valid_steps"):
+            self.valid_steps, self.valid_weights = get_stratified_steps(
+                self.schedule.num_steps, train_config["valid_steps"]
+            )
+
+    def get_inputs(self, batch, is_train):
+        # the conditional mask and side info the wrapped model's forward uses
+        model = self.model
+        processed = model.process_data(batch)
+        observed_data, observed_mask, observed_tp, gt_mask = processed[:4]
+        if len(processed) == 7:  # CSDI_Forecasting
+            feature_id = processed[6]
+            if is_train == 1 and model.target_dim_base > model.num_sample_features:
+                observed_data, observed_mask, feature_id, gt_mask = (
+                    model.sample_features(
+                        observed_data, observed_mask, feature_id, gt_mask
+                    )
+                )
+            else:
+                model.target_dim = model.target_dim_base
+                feature_id = None
+            if is_train == 0:
+                cond_mask = gt_mask
+            else:
+                cond_mask = model.get_test_pattern_mask(observed_mask, gt_mask)
+            side_info = model.get_side_info(observed_tp, cond_mask, feature_id)
+        else:
+            for_pattern_mask = processed[4]
+            if is_train == 0:
+                cond_mask = gt_mask
+            elif model.target_strategy != "random":
+                cond_mask = model.get_hist_mask(
+                    observed_mask, for_pattern_mask=for_pattern_mask
+                )
+            else:
+                cond_mask = model.get_randmask(observed_mask)
+            side_info = model.get_side_info(observed_tp, cond_mask)
+        return observed_data, observed_mask, cond_mask, side_info
+
+    def forward(self, batch, is_train=1):
+        observed_data, observed_mask, cond_mask, side_info = self.get_inputs(
+            batch, is_train
+        )
+        B = observed_data.shape[0]
+        repeated = {}
+
+        def predict_noise(noisy_data, t):
+            n = len(noisy_data) // B
+            if n not in repeated:
+                repeated.clear()
+                repeated[n] = (
+                    repeat_samples(observed_data, n),
+                    repeat_samples(cond_mask, n),
+                    repeat_samples(side_info, n),
+                )
+            obs, mask, info = repeated[n]
+            total_input = self.model.set_input_to_diffmodel(noisy_data, obs, mask)
+            return self.model.diffmodel(total_input, info, t)
+
+        if is_train == 1:
+            t = sample_timesteps(
+                B, self.k, self.schedule.num_steps, observed_data.device
+            )
+            return calc_loss_multistep(
+                predict_noise,
+                self.schedule,
+                observed_data,
+                cond_mask,
+                observed_mask,
+                t,
+            )
+        return calc_loss_valid_multistep(
+            predict_noise,
+            self.schedule,
+            observed_data,
+            cond_mask,
+            observed_mask,
+            self.valid_chunk_size,
+            self.valid_steps,
+            self.valid_weights,
+        )
+
+
+def get_loss_model(model, config):
+    # the model itself unless config["train"] asks for several diffusion steps
+    # per series or a chunked/stratified validation loss
+    train_config = config["train"]
+    if (
+        train_config.get("timesteps_per_series", 1) == 1
+        and train_config.get("valid_chunk_size", 1) == 1
+        and not train_config.get("valid_steps")
+    ):
+        return model
+    return MultistepLoss(model, config)
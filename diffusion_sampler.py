@@ -0,0 +1,212 @@
+import numpy as np
+import torch
+import torch.nn as nn
+
+import instrument
+from side_info import SideInfoCache
+
+
+def get_beta_schedule(config_diff):
+    num_steps = config_diff["num_steps"]
+    if config_diff["schedule"] == "quad":
+        beta = (
+            np.linspace(
+                config_diff["beta_start"] ** 0.5,
+                config_diff["beta_end"] ** 0.5,
+                num_steps,
+            )
+            ** 2
+        )
+    elif config_diff["schedule"] == "linear":
+        beta = np.linspace(
+            config_diff["beta_start"], config_diff["beta_end"], num_steps
+        )
+    else:
+        raise ValueError("unknown schedule: " + str(config_diff["schedule"]))
+    return beta
+
+
+def get_sample_steps(num_steps, sample_steps):
+    # evenly strided subset of the trained steps, always starting from the last one
+    if sample_steps is None or sample_steps >= num_steps:
+        return list(range(num_steps - 1, -1, -1))
+    if sample_steps < 1:
+        raise ValueError("sample_steps must be at least 1: " + str(sample_steps))
+    steps = np.linspace(num_steps - 1, 0, sample_steps).round().astype(int)
+    return sorted(set(steps.tolist()), reverse=True)
+
+
+def repeat_samples(x, n):
+    # (B,...) -> (n*B,...), sample-major, matching the folded batch in sample_batched
+    return x.unsqueeze(0).expand(n, *x.shape).reshape(n * x.shape[0], *x.shape[1:])
+
+
+class DiffusionSchedule(nn.Module):
+    # every per-step quantity of the trained schedule, precomputed once and
+    # registered as buffers so it follows .to(device) and the reverse loop only
+    # indexes device tensors (no numpy -> device copies per step)
+    def __init__(self, config_diff):
+        super().__init__()
+        self.num_steps = config_diff["num_steps"]
+        beta = get_beta_schedule(config_diff)
+        alpha_hat = 1 - beta
+        alpha = np.cumprod(alpha_hat)
+        sigma = np.zeros(self.num_steps)
+        sigma[1:] = ((1.0 - alpha[:-1]) / (1.0 - alpha[1:]) * beta[1:]) ** 0.5
+
+        def register(name, value):
+            self.register_buffer(name, torch.tensor(value, dtype=torch.float32))
+
+        register("beta", beta)
+        register("alpha_hat", alpha_hat)
+        register("alpha", alpha)
+        register("sigma", sigma)
+        register("coeff1", 1 / alpha_hat ** 0.5)
+        register("coeff2", (1 - alpha_hat) / (1 - alpha) ** 0.5)
+        self.register_buffer("steps", torch.arange(self.num_steps))
+
+    def ddpm_step(self, current_sample, predicted, t, noise=None):
+        # one ancestral step as in CSDI impute
+        with instrument.timer("reverse_step"):
+            predicted = predicted.to(current_sample.dtype)
+            current_sample = self.coeff1[t] * (
+                current_sample - self.coeff2[t] * predicted
+            )
+            if t > 0:
+                if noise is None:
+                    noise = torch.randn_like(current_sample)
+                current_sample = current_sample + self.sigma[t] * noise
+            return current_sample
+
+
+class DDIMSampler:
+    # few-step sampler (DDIM) on top of the schedule the model was trained with;
+    # eta=0 is deterministic, eta=1 matches the ancestral (DDPM) noise level
+    def __init__(self, config_diff, device):
+        self.num_steps = config_diff["num_steps"]
+        self.device = device
+        self.schedule = DiffusionSchedule(config_diff).to(device)
+
+    def get_coefficients(self, steps, eta):
+        # coefficients for all sampled steps at once, (len(steps),) each
+        alpha = self.schedule.alpha
+        alpha_t = alpha[torch.as_tensor(steps, device=alpha.device)]
+        alpha_prev = torch.cat([alpha_t[1:], alpha_t.new_ones(1)])
+        sigma = eta * (
+            (1 - alpha_prev) / (1 - alpha_t) * (1 - alpha_t / alpha_prev)
+        ).sqrt()
+        return {
+            "x0_scale": 1 / alpha_t.sqrt(),
+            "x0_noise": (1 - alpha_t).sqrt(),
+            "prev_x0": alpha_prev.sqrt(),
+            "prev_noise": (1 - alpha_prev - sigma ** 2).clamp(min=0).sqrt(),
+            "sigma": sigma,
+        }
+
+    def sample(
+        self, predict_noise, shape, sample_steps=None, eta=0.0, generator=None
+    ):
+        # predict_noise(current_sample, t) -> predicted noise at integer step t;
+        # schedule.steps[t : t + 1] is a device-resident step index for the denoiser
+        steps = get_sample_steps(self.num_steps, sample_steps)
+        c = self.get_coefficients(steps, eta)
+        current_sample = torch.randn(shape, generator=generator, device=self.device)
+        for i, t in enumerate(steps):
+            # the update stays in fp32 even if the denoiser runs under autocast
+            with instrument.timer("denoiser_forward"):
+                predicted = predict_noise(current_sample, t).to(current_sample.dtype)
+            with instrument.timer("reverse_step"):
+                x0 = (current_sample - c["x0_noise"][i] * predicted) * c["x0_scale"][i]
+                current_sample = c["prev_x0"][i] * x0 + c["prev_noise"][i] * predicted
+                if eta > 0 and i + 1 < len(steps):
+                    noise = torch.randn(
+                        shape, generator=generator, device=self.device
+                    )
+                    current_sample = current_sample + c["sigma"][i] * noise
+        return current_sample
+
+    def sample_batched(
+        self,
+        predict_noise,
+        shape,
+        nsample,
+        sample_steps=None,
+        eta=0.0,
+        max_batch=None,
+        generator=None,
+    ):
+        # all nsample trajectories run through one reverse loop with the sample
+        # axis folded into the batch axis; max_batch caps the folded batch size.
+        # predict_noise sees (n*B,...) inputs and can broadcast per-batch side
+        # info and conditional observations with repeat_samples(x, n)
+        B = shape[0]
+        chunk = nsample if max_batch is None else max(1, max_batch // B)
+        imputed_samples = []
+        for start in range(0, nsample, chunk):
+            n = min(chunk, nsample - start)
+            current_sample = self.sample(
+                predict_noise, (n * B, *shape[1:]), sample_steps, eta, generator
+            )
+            imputed_samples.append(
+                current_sample.view(n, B, *shape[1:]).transpose(0, 1)
+            )
+        return torch.cat(imputed_samples, dim=1)  # (B,nsample,...)
+
+
+class DDIMImputer(nn.Module):
+    # evaluate(batch, n_samples) as the wrapped CSDI model (CSDI_Physio,
+    # CSDI_PM25, CSDI_Forecasting), sampled with the DDIMSampler in
+    # sample_steps steps instead of the model's own ancestral loop; max_batch
+    # caps the folded batch (samples x series) per denoiser call
+    def __init__(self, model, config, sample_steps=None, eta=0.0, max_batch=None):
+        super().__init__()
+        if config["model"]["is_unconditional"]:
+            raise ValueError("the DDIM sampler needs a conditional model")
+        self.model = model
+        self.device = next(model.parameters()).device
+        self.sampler = DDIMSampler(config["diffusion"], self.device)
+        self.sample_steps = sample_steps
+        self.eta = eta
+        self.max_batch = max_batch
+        self.side_info = SideInfoCache(model.get_side_info)
+
+    def evaluate(self, batch, n_samples):
+        processed = self.model.process_data(batch)
+        observed_data, observed_mask, observed_tp, gt_mask = processed[:4]
+        cut_length = processed[5]
+        B, K, L = observed_data.shape
+        cond_mask = gt_mask
+        target_mask = observed_mask * (1 - cond_mask)
+        steps = self.sampler.schedule.steps
+
+        with torch.no_grad():
+            cond_obs = (cond_mask * observed_data).unsqueeze(1)
+            repeated = {}
+
+            def predict_noise(current_sample, t):
+                n = len(current_sample) // B
+                if n not in repeated:
+                    repeated.clear()
+                    repeated[n] = (
+                        repeat_samples(cond_obs, n),
+                        repeat_samples(cond_mask, n),
+                    )
+                obs, mask = repeated[n]
+                # built on the first call of the batch, reused by all others
+                info = self.side_info(observed_tp, cond_mask, n_samples=n)
+                noisy_target = ((1 - mask) * current_sample).unsqueeze(1)
+                diff_input = torch.cat([obs, noisy_target], dim=1)
+                return self.model.diffmodel(diff_input, info, steps[t : t + 1])
+
+            samples = self.sampler.sample_batched(
+                predict_noise,
+                (B, K, L),
+                n_samples,
+                self.sample_steps,
+                self.eta,
+                self.max_batch,
+            )
+            for i in range(len(cut_length)):  # to avoid double evaluation
+                target_mask[i, ..., 0 : cut_length[i].item()] = 0
+        self.side_info.clear()
+        return samples, observed_data, target_mask, observed_mask, observed_tp
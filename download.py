@@ -4,7 +4,6 @@ import sys
 import os
 import wget
 import requests
-import pandas as pd
 import pickle
 
 os.makedirs("data/", exist_ok=True)
@@ -13,6 +12,8 @@ if sys.argv[1] == "physio":
     wget.download(url, out="data")
     with tarfile.open("data/set-a.tar.gz", "r:gz") as t:
         t.extractall(path="data/physio")
+    from physio_cache import build_cache
+    build_cache()
 
 elif sys.argv[1] == "pm25":
     url = "https://www.microsoft.com/en-us/research/wp-content/uploads/2016/06/STMVL-Release.zip"
@@ -24,16 +25,8 @@ elif sys.argv[1] == "pm25":
         z.extractall("data/pm25")
         
     def create_normalizer_pm25():
-        df = pd.read_csv(
-            "./data/pm25/Code/STMVL/SampleData/pm25_ground.txt",
-            index_col="datetime",
-            parse_dates=True,
-        )
-        test_month = [3, 6, 9, 12]
-        for i in test_month:
-            df = df[df.index.month != i]
-        mean = df.describe().loc["mean"].values
-        std = df.describe().loc["std"].values
+        from normalizer import get_pm25_normalizer
+        mean, std = get_pm25_normalizer("./data/pm25")
         path = "./data/pm25/pm25_meanstd.pk"
         with open(path, "wb") as f:
             pickle.dump([mean, std], f)
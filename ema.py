@@ -0,0 +1,40 @@
+import contextlib
+
+import torch
+
+
+class EMA:
+    # exponential moving average of the trainable parameters, updated in place
+    # with foreach ops; swap() exchanges the parameter storages with the shadow
+    # ones (no copy of the model) for validation and evaluation
+    def __init__(self, model, decay=0.999):
+        self.decay = decay
+        self.params = [p for p in model.parameters() if p.requires_grad]
+        self.shadow = [p.detach().clone() for p in self.params]
+
+    @torch.no_grad()
+    def update(self):
+        torch._foreach_mul_(self.shadow, self.decay)
+        torch._foreach_add_(
+            self.shadow, [p.detach() for p in self.params], alpha=1 - self.decay
+        )
+
+    def _swap(self):
+        for p, s in zip(self.params, self.shadow):
+            p.data, s.data = s.data, p.data
+
+    @contextlib.contextmanager
+    def swap(self):
+        self._swap()
+        try:
+            yield
+        finally:
+            self._swap()
+
+    def state_dict(self):
+        return {"decay": self.decay, "shadow": self.shadow}
+
+    def load_state_dict(self, state_dict):
+        self.decay = state_dict["decay"]
+        for s, saved in zip(self.shadow, state_dict["shadow"]):
+            s.copy_(saved)
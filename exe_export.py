@@ -0,0 +1,68 @@
+import argparse
+import torch
+import yaml
+
+from main_model import CSDI_Physio, CSDI_PM25, CSDI_Forecasting
+from frozen_denoiser import SideInfoDenoiser, export_denoiser
+
+# traces and freezes the denoiser of a trained conditional model together with
+# its side info for fixed (K,L); the artifact is run by exe_frozen.py
+# (frozen_denoiser.FrozenImputer) without the model code
+
+parser = argparse.ArgumentParser(description="CSDI")
+parser.add_argument(
+    "--config", type=str, default=None,
+    help="default: base_forecasting.yaml for forecasting, base.yaml otherwise",
+)
+parser.add_argument(
+    "--dataset", type=str, default="physio", choices=["physio", "pm25", "forecasting"]
+)
+parser.add_argument('--device', default='cpu')
+parser.add_argument("--modelfolder", type=str, default="pretrained")
+parser.add_argument("--batch_size", type=int, default=16)
+parser.add_argument("--K", type=int, default=None, help="number of features")
+parser.add_argument("--L", type=int, default=None, help="sequence length")
+
+args = parser.parse_args()
+print(args)
+
+if args.config is None:
+    args.config = "base_forecasting.yaml" if args.dataset == "forecasting" else "base.yaml"
+path = "config/" + args.config
+with open(path, "r") as f:
+    config = yaml.safe_load(f)
+
+config["model"]["is_unconditional"] = False
+
+shapes = {"physio": (35, 48), "pm25": (36, 36)}
+K, L = shapes.get(args.dataset, (None, None))
+K = args.K if args.K is not None else K
+L = args.L if args.L is not None else L
+if K is None or L is None:
+    raise ValueError("--K and --L are required for " + args.dataset)
+
+if args.dataset == "physio":
+    model = CSDI_Physio(config, args.device)
+elif args.dataset == "pm25":
+    model = CSDI_PM25(config, args.device)
+else:
+    model = CSDI_Forecasting(config, args.device, K)
+model = model.to(args.device)
+model.load_state_dict(
+    torch.load("./save/" + args.modelfolder + "/model.pth", map_location=args.device)
+)
+
+example_inputs = (
+    torch.randn(args.batch_size, 2, K, L, device=args.device),
+    (torch.rand(args.batch_size, K, L, device=args.device) < 0.5).float(),
+    torch.zeros(1, dtype=torch.long, device=args.device),
+)
+
+output_path = "./save/" + args.modelfolder + "/denoiser_" + args.dataset + ".pt"
+export_denoiser(
+    SideInfoDenoiser(model, config, K, L),
+    example_inputs,
+    output_path,
+    meta={"config": config, "dataset": args.dataset},
+)
+print("exported to", output_path)
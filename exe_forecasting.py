@@ -5,9 +5,14 @@ import json
 import yaml
 import os
 
+import instrument
 from main_model import CSDI_Forecasting
 from dataset_forecasting import get_dataloader
+from diffusion_sampler import DDIMImputer
+from diffusion_loss import get_loss_model
+from feature_groups import GroupedForecaster, get_feature_groups
 from utils import train, evaluate
+from utils import init_distributed, broadcast_object, prepare_loader, is_main_process
 
 parser = argparse.ArgumentParser(description="CSDI")
 parser.add_argument("--config", type=str, default="base_forecasting.yaml")
@@ -16,11 +21,75 @@ parser.add_argument('--device', default='cuda:0', help='Device for Attack')
 parser.add_argument("--seed", type=int, default=1)
 parser.add_argument("--unconditional", action="store_true")
 parser.add_argument("--modelfolder", type=str, default="")
+parser.add_argument(
+    "--ema", action="store_true", help="train with and evaluate the EMA weights"
+)
+parser.add_argument(
+    "--resume", type=str, default="", help="run folder in ./save to resume training"
+)
 parser.add_argument("--nsample", type=int, default=100)
+parser.add_argument(
+    "--featuregroup", type=int, default=0,
+    help="evaluate in feature groups of this size (0: all features at once)",
+)
+parser.add_argument(
+    "--groupstrategy", type=str, default="correlation",
+    choices=["random", "correlation", "fixed"],
+)
+parser.add_argument(
+    "--maxgroups", type=int, default=None, help="feature groups per denoiser call"
+)
+parser.add_argument(
+    "--savesamples", action="store_true", help="save all generated samples"
+)
+parser.add_argument(
+    "--precision", type=str, default="fp32", choices=["fp32", "bf16", "fp16"],
+    help="inference precision of the denoiser",
+)
+parser.add_argument(
+    "--samplesteps", type=int, default=None,
+    help="sample with a DDIM sampler in this many steps (default: the model's own sampler)",
+)
+parser.add_argument(
+    "--eta", type=float, default=0.0,
+    help="noise level of the DDIM sampler (0: deterministic, 1: ancestral)",
+)
+parser.add_argument(
+    "--maxbatch", type=int, default=None,
+    help="with --samplesteps, at most this many series x samples per denoiser call",
+)
+parser.add_argument(
+    "--launcher", type=str, default="none", choices=["none", "torchrun"],
+    help="torchrun: data-parallel training, world size and hosts set by torchrun",
+)
+parser.add_argument("--backend", type=str, default="gloo", help="gloo (cpu) or nccl")
+parser.add_argument(
+    "--prefetch", action="store_true",
+    help="load and copy the next batches to the device on a background thread",
+)
+parser.add_argument(
+    "--deviceresident", action="store_true",
+    help="keep the whole normalized dataset on the device",
+)
+parser.add_argument(
+    "--instrument", action="store_true",
+    help="write per-phase timers and counters (and a profiler trace) to the run folder",
+)
+parser.add_argument(
+    "--profilesteps", type=int, default=5,
+    help="steps in the profiler trace with --instrument (0: no trace)",
+)
 
 args = parser.parse_args()
+if args.maxbatch is not None and args.samplesteps is None:
+    parser.error("--maxbatch needs --samplesteps")
 print(args)
 
+if args.launcher == "torchrun":
+    init_distributed(args.backend)
+    if args.device.startswith("cuda"):
+        args.device = "cuda:" + os.environ["LOCAL_RANK"]
+
 path = "config/" + args.config
 with open(path, "r") as f:
     config = yaml.safe_load(f)
@@ -30,39 +99,83 @@ if args.datatype == 'electricity':
 
 config["model"]["is_unconditional"] = args.unconditional
 
+if args.ema and not config["train"].get("ema_decay"):
+    config["train"]["ema_decay"] = 0.999
+
 print(json.dumps(config, indent=4))
 
 current_time = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
 foldername = "./save/forecasting_" + args.datatype + '_' + current_time + "/"
+if args.resume != "":
+    foldername = "./save/" + args.resume + "/"
+foldername = broadcast_object(foldername)  # same folder on every rank
 print('model folder:', foldername)
-os.makedirs(foldername, exist_ok=True)
-with open(foldername + "config.json", "w") as f:
-    json.dump(config, f, indent=4)
+if is_main_process():
+    os.makedirs(foldername, exist_ok=True)
+    with open(foldername + "config.json", "w") as f:
+        json.dump(config, f, indent=4)
+if args.instrument:
+    os.makedirs(foldername, exist_ok=True)
+    instrument.enable(foldername, args.profilesteps, device=args.device)
 
 train_loader, valid_loader, test_loader, scaler, mean_scaler = get_dataloader(
     datatype=args.datatype,
     device= args.device,
     batch_size=config["train"]["batch_size"],
 )
+train_loader, valid_loader, test_loader = [
+    prepare_loader(loader, args.device, args.prefetch, args.deviceresident, shard)
+    for loader, shard in [(train_loader, True), (valid_loader, True), (test_loader, False)]
+]
 
 model = CSDI_Forecasting(config, args.device, target_dim).to(args.device)
 
+ema = None
 if args.modelfolder == "":
-    train(
+    ema = train(
         model,
         config["train"],
         train_loader,
         valid_loader=valid_loader,
         foldername=foldername,
+        resume=args.resume != "",
+        loss_model=get_loss_model(model, config),
     )
 else:
-    model.load_state_dict(torch.load("./save/" + args.modelfolder + "/model.pth"))
+    model_file = "/model_ema.pth" if args.ema else "/model.pth"
+    model.load_state_dict(torch.load("./save/" + args.modelfolder + model_file))
+
+eval_model = model
+if args.featuregroup > 0:
+    dataset = test_loader.dataset
+    # correlations over the part of the series before validation and test
+    train_end = len(dataset.main_data) - dataset.valid_length - dataset.test_length
+    groups, owner = get_feature_groups(
+        target_dim,
+        args.featuregroup,
+        args.groupstrategy,
+        series=dataset.main_data[:train_end],
+        mask=dataset.mask_data[:train_end],
+        seed=args.seed,
+    )
+    eval_model = GroupedForecaster(
+        model, config, groups, owner, args.maxgroups, args.samplesteps, args.eta
+    )
+elif args.samplesteps is not None:
+    eval_model = DDIMImputer(
+        model, config, args.samplesteps, args.eta, args.maxbatch
+    )
 
 evaluate(
-    model,
+    eval_model,
     test_loader,
     nsample=args.nsample,
     scaler=scaler,
     mean_scaler=mean_scaler,
     foldername=foldername,
+    save_samples=args.savesamples,
+    precision=args.precision,
+    seed=args.seed,
+    ema=ema if args.ema else None,
 )
+instrument.stop()
@@ -0,0 +1,86 @@
+import argparse
+import datetime
+import os
+
+from frozen_denoiser import FrozenImputer
+from utils import evaluate
+
+# imputation/forecasting on the test set with an artifact written by
+# exe_export.py: only the dataset code and torch are needed, the model classes
+# (and linear_attention_transformer) are never imported
+
+parser = argparse.ArgumentParser(description="CSDI")
+parser.add_argument(
+    "--dataset", type=str, default="physio", choices=["physio", "pm25", "forecasting"]
+)
+parser.add_argument("--datatype", type=str, default="electricity")
+parser.add_argument('--device', default='cpu')
+parser.add_argument("--modelfolder", type=str, default="pretrained")
+parser.add_argument("--seed", type=int, default=1)
+parser.add_argument("--testmissingratio", type=float, default=0.1)
+parser.add_argument("--nfold", type=int, default=0)
+parser.add_argument("--validationindex", type=int, default=0)
+parser.add_argument("--nsample", type=int, default=100)
+parser.add_argument(
+    "--samplesteps", type=int, default=None,
+    help="sample with a DDIM sampler in this many steps (default: all trained steps)",
+)
+parser.add_argument(
+    "--eta", type=float, default=1.0,
+    help="noise level of the sampler (1: ancestral, 0: deterministic)",
+)
+parser.add_argument(
+    "--maxbatch", type=int, default=None,
+    help="at most this many series x samples per denoiser call",
+)
+parser.add_argument(
+    "--savesamples", action="store_true", help="save all generated samples"
+)
+
+args = parser.parse_args()
+print(args)
+
+artifact = "./save/" + args.modelfolder + "/denoiser_" + args.dataset + ".pt"
+model = FrozenImputer(
+    artifact, args.device, args.samplesteps, args.eta, args.maxbatch
+)
+batch_size = model.meta["config"]["train"]["batch_size"]
+
+scaler, mean_scaler = 1, 0
+if args.dataset == "physio":
+    from dataset_physio import get_dataloader
+
+    _, _, test_loader = get_dataloader(
+        seed=args.seed,
+        nfold=args.nfold,
+        batch_size=batch_size,
+        missing_ratio=args.testmissingratio,
+    )
+elif args.dataset == "pm25":
+    from dataset_pm25 import get_dataloader
+
+    _, _, test_loader, scaler, mean_scaler = get_dataloader(
+        batch_size, device=args.device, validindex=args.validationindex
+    )
+else:
+    from dataset_forecasting import get_dataloader
+
+    _, _, test_loader, scaler, mean_scaler = get_dataloader(
+        datatype=args.datatype, device=args.device, batch_size=batch_size
+    )
+
+current_time = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+foldername = "./save/frozen_" + args.dataset + "_" + current_time + "/"
+print('model folder:', foldername)
+os.makedirs(foldername, exist_ok=True)
+
+evaluate(
+    model,
+    test_loader,
+    nsample=args.nsample,
+    scaler=scaler,
+    mean_scaler=mean_scaler,
+    foldername=foldername,
+    save_samples=args.savesamples,
+    seed=args.seed,
+)
@@ -1,13 +1,19 @@
 import argparse
 import torch
 import datetime
+import functools
 import json
 import yaml
 import os
 
+import instrument
 from main_model import CSDI_Physio
+from diffusion_sampler import DDIMImputer
+from diffusion_loss import get_loss_model
 from dataset_physio import get_dataloader
+from physio_cache import get_dataloader as get_cache_dataloader
 from utils import train, evaluate
+from utils import init_distributed, broadcast_object, prepare_loader, is_main_process
 
 parser = argparse.ArgumentParser(description="CSDI")
 parser.add_argument("--config", type=str, default="base.yaml")
@@ -18,12 +24,83 @@ parser.add_argument(
     "--nfold", type=int, default=0, help="for 5fold test (valid value:[0-4])"
 )
 parser.add_argument("--unconditional", action="store_true")
+parser.add_argument(
+    "--physiocache", action="store_true",
+    help="read the memory-mapped cache built by physio_cache.py",
+)
+parser.add_argument(
+    "--onlinemasks", action="store_true",
+    help="with --physiocache, draw the test masks per batch on the device",
+)
+parser.add_argument(
+    "--bucketing", action="store_true",
+    help="with --physiocache, batch patients of similar length with dynamic padding",
+)
+parser.add_argument(
+    "--foldnormalizer", action="store_true",
+    help="with --physiocache, normalize with the mean/std without the test fold",
+)
 parser.add_argument("--modelfolder", type=str, default="")
+parser.add_argument(
+    "--ema", action="store_true", help="train with and evaluate the EMA weights"
+)
+parser.add_argument(
+    "--resume", type=str, default="", help="run folder in ./save to resume training"
+)
 parser.add_argument("--nsample", type=int, default=100)
+parser.add_argument(
+    "--savesamples", action="store_true", help="save all generated samples"
+)
+parser.add_argument(
+    "--precision", type=str, default="fp32", choices=["fp32", "bf16", "fp16"],
+    help="inference precision of the denoiser",
+)
+parser.add_argument(
+    "--samplesteps", type=int, default=None,
+    help="sample with a DDIM sampler in this many steps (default: the model's own sampler)",
+)
+parser.add_argument(
+    "--eta", type=float, default=0.0,
+    help="noise level of the DDIM sampler (0: deterministic, 1: ancestral)",
+)
+parser.add_argument(
+    "--maxbatch", type=int, default=None,
+    help="with --samplesteps, at most this many series x samples per denoiser call",
+)
+parser.add_argument(
+    "--launcher", type=str, default="none", choices=["none", "torchrun"],
+    help="torchrun: data-parallel training, world size and hosts set by torchrun",
+)
+parser.add_argument("--backend", type=str, default="gloo", help="gloo (cpu) or nccl")
+parser.add_argument(
+    "--prefetch", action="store_true",
+    help="load and copy the next batches to the device on a background thread",
+)
+parser.add_argument(
+    "--deviceresident", action="store_true",
+    help="keep the whole normalized dataset on the device",
+)
+parser.add_argument(
+    "--instrument", action="store_true",
+    help="write per-phase timers and counters (and a profiler trace) to the run folder",
+)
+parser.add_argument(
+    "--profilesteps", type=int, default=5,
+    help="steps in the profiler trace with --instrument (0: no trace)",
+)
 
 args = parser.parse_args()
+if args.maxbatch is not None and args.samplesteps is None:
+    parser.error("--maxbatch needs --samplesteps")
+if args.foldnormalizer and not args.physiocache:
+    parser.error("--foldnormalizer needs --physiocache")
 print(args)
 
+if args.launcher == "torchrun":
+    init_distributed(args.backend)
+    if args.device.startswith("cuda"):
+        args.device = "cuda:" + os.environ["LOCAL_RANK"]
+
 path = "config/" + args.config
 with open(path, "r") as f:
     config = yaml.safe_load(f)
@@ -31,33 +108,76 @@ with open(path, "r") as f:
 config["model"]["is_unconditional"] = args.unconditional
 config["model"]["test_missing_ratio"] = args.testmissingratio
 
+if args.ema and not config["train"].get("ema_decay"):
+    config["train"]["ema_decay"] = 0.999
+
 print(json.dumps(config, indent=4))
 
 current_time = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
 foldername = "./save/physio_fold" + str(args.nfold) + "_" + current_time + "/"
+if args.resume != "":
+    foldername = "./save/" + args.resume + "/"
+foldername = broadcast_object(foldername)  # same folder on every rank
 print('model folder:', foldername)
-os.makedirs(foldername, exist_ok=True)
-with open(foldername + "config.json", "w") as f:
-    json.dump(config, f, indent=4)
+if is_main_process():
+    os.makedirs(foldername, exist_ok=True)
+    with open(foldername + "config.json", "w") as f:
+        json.dump(config, f, indent=4)
+if args.instrument:
+    os.makedirs(foldername, exist_ok=True)
+    instrument.enable(foldername, args.profilesteps, device=args.device)
 
+if args.physiocache:
+    get_dataloader = functools.partial(
+        get_cache_dataloader,
+        online_masks=args.onlinemasks,
+        device=args.device if args.onlinemasks else None,
+        bucketing=args.bucketing,
+        fold_normalizer=args.foldnormalizer,
+    )
 train_loader, valid_loader, test_loader = get_dataloader(
     seed=args.seed,
     nfold=args.nfold,
     batch_size=config["train"]["batch_size"],
     missing_ratio=config["model"]["test_missing_ratio"],
 )
+train_loader, valid_loader, test_loader = [
+    prepare_loader(loader, args.device, args.prefetch, args.deviceresident, shard)
+    for loader, shard in [(train_loader, True), (valid_loader, True), (test_loader, False)]
+]
 
 model = CSDI_Physio(config, args.device).to(args.device)
 
+ema = None
 if args.modelfolder == "":
-    train(
+    ema = train(
         model,
         config["train"],
         train_loader,
         valid_loader=valid_loader,
         foldername=foldername,
+        resume=args.resume != "",
+        loss_model=get_loss_model(model, config),
     )
 else:
-    model.load_state_dict(torch.load("./save/" + args.modelfolder + "/model.pth"))
+    model_file = "/model_ema.pth" if args.ema else "/model.pth"
+    model.load_state_dict(torch.load("./save/" + args.modelfolder + model_file))
 
-evaluate(model, test_loader, nsample=args.nsample, scaler=1, foldername=foldername)
+eval_model = model
+if args.samplesteps is not None:
+    eval_model = DDIMImputer(
+        model, config, args.samplesteps, args.eta, args.maxbatch
+    )
+
+evaluate(
+    eval_model,
+    test_loader,
+    nsample=args.nsample,
+    scaler=1,
+    foldername=foldername,
+    save_samples=args.savesamples,
+    precision=args.precision,
+    seed=args.seed,
+    ema=ema if args.ema else None,
+)
+instrument.stop()
@@ -0,0 +1,179 @@
+import functools
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+import instrument
+from diffusion_sampler import DDIMSampler, DiffusionSchedule, repeat_samples
+from side_info import SideInfoCache, TimeEmbeddingTable
+
+# full-feature inference for a model trained on feature subsets
+# (num_sample_features): the K features are split into groups of group_size,
+# every group is imputed with the group's own feature embeddings and the time
+# side info shared by all groups, and the groups run folded into the batch
+# axis. Feature attention then costs O(K x group_size) instead of O(K^2).
+
+
+def get_correlation_order(series, mask, group_size):
+    # greedy clustering: the first unassigned feature and its group_size - 1
+    # most correlated unassigned features form the next group
+    # series, mask: (T,K), correlations over the observed entries
+    series = np.asarray(series, dtype=np.float32)
+    mask = np.asarray(mask, dtype=bool)
+    count = np.maximum(mask.sum(0), 1)
+    mean = np.where(mask, series, 0).sum(0) / count
+    z = np.where(mask, series - mean, 0)
+    z = z / np.maximum(np.sqrt((z ** 2).sum(0)), 1e-8)
+    corr = z.T @ z  # (K,K)
+
+    remaining = np.ones(series.shape[1], dtype=bool)
+    order = []
+    while remaining.any():
+        candidates = np.flatnonzero(remaining)
+        first = candidates[0]
+        sims = corr[first, candidates]
+        sims[0] = np.inf  # the first feature always starts its group
+        group = candidates[np.argsort(-sims, kind="stable")[:group_size]]
+        order.extend(group.tolist())
+        remaining[group] = False
+    return np.array(order)
+
+
+def get_feature_groups(K, group_size, strategy="fixed", series=None, mask=None, seed=0):
+    # (G,group_size) feature ids and (G,group_size) owner mask. The features
+    # are ordered by the strategy and cut into consecutive groups; the last
+    # group is shifted back to stay full, its features that already belong to
+    # the previous group are not owned (their output comes from that group)
+    group_size = min(group_size, K)
+    if strategy == "fixed":
+        order = np.arange(K)
+    elif strategy == "random":
+        order = np.random.RandomState(seed).permutation(K)
+    elif strategy == "correlation":
+        if series is None:
+            raise ValueError("the correlation strategy needs the training series")
+        if mask is None:
+            mask = np.ones_like(series, dtype=bool)
+        order = get_correlation_order(series, mask, group_size)
+    else:
+        raise ValueError("unknown feature group strategy: " + str(strategy))
+
+    starts = list(range(0, K - group_size + 1, group_size))
+    if starts[-1] + group_size < K:
+        starts.append(K - group_size)
+    groups = np.stack([order[s : s + group_size] for s in starts])
+    owner = np.ones(groups.shape, dtype=bool)
+    if len(starts) > 1:
+        owner[-1, : starts[-2] + group_size - starts[-1]] = False
+    return torch.from_numpy(groups).long(), torch.from_numpy(owner)
+
+
+class GroupedForecaster(nn.Module):
+    # evaluate(batch, n_samples) as the wrapped CSDI_Forecasting, sampled group
+    # by group with the ancestral CSDI sampler (or the DDIMSampler in
+    # sample_steps steps); max_groups caps the groups per denoiser call
+    def __init__(
+        self, model, config, groups, owner, max_groups=None, sample_steps=None, eta=0.0
+    ):
+        super().__init__()
+        if config["model"]["is_unconditional"]:
+            raise ValueError("feature groups need a conditional model")
+        self.model = model
+        self.device = next(model.parameters()).device
+        self.schedule = DiffusionSchedule(config["diffusion"]).to(self.device)
+        self.time_table = TimeEmbeddingTable(config["model"]["timeemb"])
+        self.side_info = SideInfoCache(self.get_side_info)
+        self.register_buffer("groups", groups.to(self.device))
+        self.register_buffer("owner", owner.to(self.device))
+        self.max_groups = len(groups) if max_groups is None else max_groups
+        self.sampler = None
+        if sample_steps is not None:
+            self.sampler = DDIMSampler(config["diffusion"], self.device)
+        self.sample_steps = sample_steps
+        self.eta = eta
+
+    def split(self, x, groups):
+        # (B,K,L) -> (g*B,group_size,L), group-major
+        x = x[:, groups]  # (B,g,group_size,L)
+        return x.transpose(0, 1).reshape(-1, *x.shape[2:])
+
+    def get_side_info(self, time_embed, groups, cond_mask):
+        # time_embed (B,L,timeemb) is shared by all groups
+        with instrument.timer("side_info"):
+            g, group_size = groups.shape
+            B, L, _ = time_embed.shape
+            feature_embed = self.model.embed_layer(groups)  # (g,group_size,featureemb)
+            time_embed = time_embed.permute(0, 2, 1).unsqueeze(2)  # (B,timeemb,1,L)
+            time_embed = time_embed.unsqueeze(0).expand(g, -1, -1, group_size, -1)
+            feature_embed = feature_embed.permute(0, 2, 1).unsqueeze(1).unsqueeze(-1)
+            feature_embed = feature_embed.expand(-1, B, -1, -1, L)
+            side_info = torch.cat([time_embed, feature_embed], dim=2)
+            side_info = side_info.reshape(g * B, -1, group_size, L)
+            return torch.cat([side_info, cond_mask.unsqueeze(1)], dim=1)
+
+    def impute(self, observed_data, cond_mask, get_side_info, n_samples):
+        # (N,group_size,L) -> (n_samples,N,group_size,L), samples folded into the
+        # batch; get_side_info(n_samples=n) returns the cached side info
+        cond_obs = repeat_samples(cond_mask * observed_data, n_samples).unsqueeze(1)
+        cond_mask = repeat_samples(cond_mask, n_samples).unsqueeze(1)
+        if self.sampler is not None:
+
+            def predict_noise(current_sample, t):
+                noisy_target = (1 - cond_mask) * current_sample.unsqueeze(1)
+                total_input = torch.cat([cond_obs, noisy_target], dim=1)
+                return self.model.diffmodel(
+                    total_input,
+                    get_side_info(n_samples=n_samples),
+                    self.schedule.steps[t : t + 1],
+                )
+
+            current_sample = self.sampler.sample(
+                predict_noise, cond_obs[:, 0].shape, self.sample_steps, self.eta
+            )
+            return current_sample.view(n_samples, -1, *observed_data.shape[1:])
+        current_sample = torch.randn_like(cond_obs)
+        for t in range(self.schedule.num_steps - 1, -1, -1):
+            noisy_target = (1 - cond_mask) * current_sample
+            total_input = torch.cat([cond_obs, noisy_target], dim=1)
+            with instrument.timer("denoiser_forward"):
+                predicted = self.model.diffmodel(
+                    total_input,
+                    get_side_info(n_samples=n_samples),
+                    self.schedule.steps[t : t + 1],
+                )
+            current_sample = self.schedule.ddpm_step(
+                current_sample, predicted.unsqueeze(1), t
+            )
+        return current_sample.view(n_samples, -1, *observed_data.shape[1:])
+
+    def evaluate(self, batch, n_samples):
+        observed_data = batch["observed_data"].to(self.device).float().permute(0, 2, 1)
+        observed_mask = batch["observed_mask"].to(self.device).float().permute(0, 2, 1)
+        gt_mask = batch["gt_mask"].to(self.device).float().permute(0, 2, 1)
+        observed_tp = batch["timepoints"].to(self.device).float()
+        B, K, L = observed_data.shape
+        target_mask = observed_mask * (1 - gt_mask)
+
+        time_embed = self.time_table(observed_tp)
+        samples = torch.zeros(B, n_samples, K, L, device=self.device)
+        with torch.no_grad():
+            for start in range(0, len(self.groups), self.max_groups):
+                groups = self.groups[start : start + self.max_groups]
+                owner = self.owner[start : start + self.max_groups]
+                g = len(groups)
+                cond_mask = self.split(gt_mask, groups)
+                get_side_info = functools.partial(
+                    self.side_info, time_embed, groups, cond_mask
+                )
+                group_samples = self.impute(
+                    self.split(observed_data, groups),
+                    cond_mask,
+                    get_side_info,
+                    n_samples,
+                )  # (n_samples,g*B,group_size,L)
+                group_samples = group_samples.view(n_samples, g, B, -1, L)
+                group_samples = group_samples.permute(2, 0, 1, 3, 4)[:, :, owner]
+                samples.index_copy_(2, groups[owner], group_samples)
+        self.side_info.clear()
+        return samples, observed_data, target_mask, observed_mask, observed_tp
@@ -0,0 +1,125 @@
+import json
+
+import torch
+import torch.nn as nn
+
+import instrument
+
+from diffusion_sampler import DDIMSampler, repeat_samples
+from side_info import TimeEmbeddingTable, get_side_info
+
+# Self-contained TorchScript artifact for the denoiser. Loading it only needs
+# torch: the model classes (and linear_attention_transformer) are not imported.
+# The exported module has the side info of a fixed (K,L) baked in, so
+# inference only passes the diffusion input, the conditional mask and the step.
+
+
+class SideInfoDenoiser(nn.Module):
+    # model.diffmodel with the time embedding of timepoints 0..L-1 and the
+    # learned feature embedding of the K features as constants; only the
+    # conditional mask part of the side info is built per call
+    def __init__(self, model, config, K, L):
+        super().__init__()
+        self.diffmodel = model.diffmodel
+        device = next(model.parameters()).device
+        observed_tp = torch.arange(L, dtype=torch.float32, device=device).unsqueeze(0)
+        with torch.no_grad():
+            feature_embed = model.embed_layer(torch.arange(K, device=device))
+            side_info = get_side_info(
+                observed_tp,
+                torch.zeros(1, K, L, device=device),
+                TimeEmbeddingTable(config["model"]["timeemb"]),
+                feature_embed,
+                is_unconditional=True,
+            )
+        self.register_buffer("side_info", side_info)  # (1,timeemb+featureemb,K,L)
+
+    def forward(self, diff_input, cond_mask, diffusion_step):
+        side_info = self.side_info.expand(cond_mask.shape[0], -1, -1, -1)
+        side_info = torch.cat([side_info, cond_mask.unsqueeze(1)], dim=1)
+        return self.diffmodel(diff_input, side_info, diffusion_step)
+
+
+def export_denoiser(denoiser, example_inputs, path, meta=None):
+    # example_inputs: (diff_input (B,2,K,L), cond_mask (B,K,L), diffusion_step (1,))
+    denoiser = denoiser.eval()
+    with torch.no_grad():
+        traced = torch.jit.trace(denoiser, example_inputs)
+        frozen = torch.jit.freeze(traced)
+    meta = dict(meta or {})
+    meta["input_shapes"] = [list(x.shape) for x in example_inputs]
+    torch.jit.save(frozen, path, _extra_files={"meta.json": json.dumps(meta)})
+    return frozen
+
+
+def load_denoiser(path, device="cpu"):
+    extra_files = {"meta.json": ""}
+    denoiser = torch.jit.load(path, map_location=device, _extra_files=extra_files)
+    meta = json.loads(extra_files["meta.json"])
+    return denoiser, meta
+
+
+class FrozenImputer(nn.Module):
+    # evaluate(batch, n_samples) as the exported CSDI model, from the artifact
+    # alone. Batches must have the exported K and L and timepoints 0..L-1.
+    # sample_steps=None with eta=1 samples as the model's own ancestral loop;
+    # fewer steps or eta=0 use the DDIM sampler
+    def __init__(self, path, device="cpu", sample_steps=None, eta=1.0, max_batch=None):
+        super().__init__()
+        self.denoiser, self.meta = load_denoiser(path, device)
+        self.device = torch.device(device)
+        self.sampler = DDIMSampler(self.meta["config"]["diffusion"], self.device)
+        self.shape = self.meta["input_shapes"][1][1:]  # [K,L]
+        self.sample_steps = sample_steps
+        self.eta = eta
+        self.max_batch = max_batch
+
+    def evaluate(self, batch, n_samples):
+        observed_data = batch["observed_data"].to(self.device).float().permute(0, 2, 1)
+        observed_mask = batch["observed_mask"].to(self.device).float().permute(0, 2, 1)
+        gt_mask = batch["gt_mask"].to(self.device).float().permute(0, 2, 1)
+        observed_tp = batch["timepoints"].to(self.device).float()
+        B, K, L = observed_data.shape
+        if [K, L] != self.shape:
+            raise ValueError(
+                "the artifact was exported for (K,L)=" + str(tuple(self.shape))
+                + ", got " + str((K, L))
+            )
+        # the time embedding of timepoints 0..L-1 is baked into the artifact
+        timepoints = torch.arange(L, dtype=observed_tp.dtype, device=self.device)
+        if not torch.equal(observed_tp, timepoints.expand(B, L)):
+            raise ValueError(
+                "the artifact was exported for timepoints 0..L-1, got "
+                + str(observed_tp.tolist())
+            )
+        cond_mask = gt_mask
+        target_mask = observed_mask * (1 - cond_mask)
+        if "cut_length" in batch:
+            for i, length in enumerate(batch["cut_length"].tolist()):
+                target_mask[i, ..., 0:length] = 0  # to avoid double evaluation
+        cond_obs = (cond_mask * observed_data).unsqueeze(1)
+        steps = self.sampler.schedule.steps
+        repeated = {}
+
+        def predict_noise(current_sample, t):
+            n = len(current_sample) // B
+            if n not in repeated:
+                repeated.clear()
+                repeated[n] = (repeat_samples(cond_obs, n), repeat_samples(cond_mask, n))
+            obs, mask = repeated[n]
+            # the time and feature embeddings are constants of the artifact
+            instrument.count("side_info_avoided")
+            noisy_target = ((1 - mask) * current_sample).unsqueeze(1)
+            diff_input = torch.cat([obs, noisy_target], dim=1)
+            return self.denoiser(diff_input, mask, steps[t : t + 1])
+
+        with torch.no_grad():
+            samples = self.sampler.sample_batched(
+                predict_noise,
+                (B, K, L),
+                n_samples,
+                self.sample_steps,
+                self.eta,
+                self.max_batch,
+            )
+        return samples, observed_data, target_mask, observed_mask, observed_tp
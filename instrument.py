@@ -0,0 +1,131 @@
+import contextlib
+import json
+import os
+import time
+
+import torch
+import torch.distributed as dist
+
+# named timers and counters for the hot paths of train and evaluate (data
+# loading, side info, denoiser forward, reverse step, median/quantiles, CRPS,
+# serialization). Off by default, and then every timer() is a shared null
+# context. enable() turns them on: flush() appends one JSON line per timer and
+# counter to <folder>/instrument.jsonl (instrument_rank<r>.jsonl under
+# torch.distributed), and with profile_steps a torch.profiler Chrome trace of
+# that many step()s is written to <folder>/trace.json. On CUDA, timers
+# synchronize the device so each phase is charged its own kernels.
+
+_null = contextlib.nullcontext()
+_state = {
+    "enabled": False,
+    "folder": None,
+    "synchronize": False,
+    "timers": {},
+    "counters": {},
+    "profiler": None,
+}
+
+
+def enabled():
+    return _state["enabled"]
+
+
+def enable(folder, profile_steps=0, profile_wait=5, device=None):
+    _state.update(
+        enabled=True,
+        folder=folder,
+        synchronize=torch.device(device).type == "cuda" if device else False,
+        timers={},
+        counters={},
+    )
+    if profile_steps > 0:
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+
+        def export(profiler):
+            profiler.export_chrome_trace(os.path.join(folder, _filename("trace", "json")))
+
+        profiler = torch.profiler.profile(
+            activities=activities,
+            schedule=torch.profiler.schedule(
+                wait=profile_wait, warmup=1, active=profile_steps, repeat=1
+            ),
+            on_trace_ready=export,
+            record_shapes=True,
+        )
+        profiler.start()
+        _state["profiler"] = profiler
+
+
+def _filename(name, extension):
+    if dist.is_available() and dist.is_initialized():
+        name += "_rank" + str(dist.get_rank())
+    return name + "." + extension
+
+
+@contextlib.contextmanager
+def _timer(name):
+    with torch.profiler.record_function(name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if _state["synchronize"]:
+                torch.cuda.synchronize()
+            count, total = _state["timers"].get(name, (0, 0.0))
+            _state["timers"][name] = (count + 1, total + time.perf_counter() - start)
+
+
+def timer(name):
+    if not _state["enabled"]:
+        return _null
+    return _timer(name)
+
+
+def count(name, n=1):
+    if _state["enabled"]:
+        _state["counters"][name] = _state["counters"].get(name, 0) + n
+
+
+def timed_iter(iterable, name="data_loading"):
+    # the time spent waiting for each item of iterable
+    iterator = iter(iterable)
+    while True:
+        with timer(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def step():
+    # one training or evaluation step, for the profiler window
+    if _state["profiler"] is not None:
+        _state["profiler"].step()
+
+
+def flush(**tags):
+    # appends the timers and counters since the last flush, then resets them
+    if not _state["enabled"]:
+        return
+    records = []
+    for name, (n, total) in sorted(_state["timers"].items()):
+        records.append(
+            dict(tags, name=name, count=n, total_s=total, mean_ms=total / n * 1e3)
+        )
+    for name, value in sorted(_state["counters"].items()):
+        records.append(dict(tags, name=name, count=value))
+    path = os.path.join(_state["folder"], _filename("instrument", "jsonl"))
+    with open(path, "a") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+    _state["timers"] = {}
+    _state["counters"] = {}
+
+
+def stop():
+    if _state["profiler"] is not None:
+        _state["profiler"].stop()
+        _state["profiler"] = None
@@ -0,0 +1,122 @@
+import numpy as np
+import torch
+
+from utils import get_batch_numbers
+
+# masks for a whole batch in a few tensor ops instead of per-sample python
+# loops. Every function takes an optional torch.Generator; get_generator seeds
+# one per batch from (seed, epoch, batch_no) so masks are reproducible no
+# matter which worker or rank produced the batch.
+
+
+def get_generator(seed, *keys, device="cpu"):
+    state = np.random.SeedSequence([seed, *keys]).generate_state(2, np.uint32)
+    generator = torch.Generator(device=device)
+    generator.manual_seed((int(state[0]) << 31) ^ int(state[1]))
+    return generator
+
+
+def _rand(shape, generator, device):
+    gen_device = generator.device if generator is not None else device
+    return torch.rand(shape, generator=generator, device=gen_device).to(device)
+
+
+def drop_observed(observed_mask, num_drop, generator=None):
+    # observed_mask (B,...) with num_drop[b] of the observed entries of series b
+    # set to 0, chosen uniformly at random
+    B = observed_mask.shape[0]
+    flat = observed_mask.reshape(B, -1)
+    rand = _rand(flat.shape, generator, flat.device).masked_fill(flat == 0, -1.0)
+    # the num_drop largest draws of each row are dropped: keep what lies below
+    # the num_drop-th largest (rows dropping nothing get a threshold above 1)
+    num_drop = num_drop.to(flat.device).unsqueeze(1)
+    max_drop = max(int(num_drop.max()), 1)
+    top_rand = rand.topk(max_drop, dim=1).values  # descending
+    threshold = top_rand.gather(1, (num_drop - 1).clamp(min=0))
+    threshold = threshold.masked_fill(num_drop == 0, 2.0)
+    keep = rand < threshold
+    return (flat * keep).reshape(observed_mask.shape)
+
+
+def get_test_mask(observed_mask, missing_ratio, generator=None):
+    # ground-truth mask: missing_ratio of the observed values of each series
+    # held out for evaluation (the physio --testmissingratio masks)
+    num_observed = observed_mask.reshape(len(observed_mask), -1).sum(1)
+    num_drop = (num_observed.double() * missing_ratio).floor().long()
+    return drop_observed(observed_mask, num_drop, generator)
+
+
+def get_randmask(observed_mask, generator=None):
+    # "random" training strategy: a uniform ratio in [0,1) per series
+    B = len(observed_mask)
+    num_observed = observed_mask.reshape(B, -1).sum(1)
+    sample_ratio = _rand(B, generator, observed_mask.device)
+    num_drop = (num_observed * sample_ratio).round().long()
+    return drop_observed(observed_mask, num_drop, generator)
+
+
+def get_hist_mask(
+    observed_mask, for_pattern_mask=None, target_strategy="mix", generator=None
+):
+    # "historical" training strategy: the missing pattern of the previous series
+    # in the batch; "mix" picks the random strategy for half of the series
+    if for_pattern_mask is None:
+        for_pattern_mask = observed_mask
+    cond_mask = observed_mask * for_pattern_mask.roll(1, dims=0)
+    if target_strategy == "mix":
+        rand_mask = get_randmask(observed_mask, generator)
+        B = len(observed_mask)
+        mask_choice = _rand(B, generator, observed_mask.device) > 0.5
+        mask_choice = mask_choice.view(B, *[1] * (observed_mask.dim() - 1))
+        cond_mask = torch.where(mask_choice, rand_mask, cond_mask)
+    return cond_mask
+
+
+def get_cond_mask(
+    observed_mask, target_strategy="random", for_pattern_mask=None, generator=None
+):
+    if target_strategy == "random":
+        return get_randmask(observed_mask, generator)
+    return get_hist_mask(observed_mask, for_pattern_mask, target_strategy, generator)
+
+
+class MaskedLoader:
+    # wraps a loader whose datasets only ship raw observations and adds the
+    # "gt_mask" of every batch, drawn with a generator seeded per batch (and per
+    # epoch when per_epoch is set, e.g. for shuffled training loaders)
+    def __init__(self, loader, missing_ratio, seed=0, per_epoch=False, device=None):
+        self.loader = loader
+        self.missing_ratio = missing_ratio
+        self.seed = seed
+        self.per_epoch = per_epoch
+        self.device = device
+        self.epoch = 0
+
+    def with_loader(self, loader):
+        return MaskedLoader(
+            loader, self.missing_ratio, self.seed, self.per_epoch, self.device
+        )
+
+    def __iter__(self):
+        epoch = self.epoch
+        if self.per_epoch:
+            self.epoch += 1
+        # global batch numbers, so a sharded loader draws the same masks
+        for batch_no, batch in zip(get_batch_numbers(self.loader), self.loader):
+            observed_mask = batch["observed_mask"]
+            if self.device is not None:
+                observed_mask = observed_mask.to(self.device, non_blocking=True)
+            generator = get_generator(
+                self.seed, epoch, batch_no, device=observed_mask.device
+            )
+            batch["gt_mask"] = get_test_mask(
+                observed_mask, self.missing_ratio, generator
+            )
+            yield batch
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        # sampler, dataset, batch_size, ... of the wrapped loader
+        return getattr(self.__dict__["loader"], name)
@@ -0,0 +1,159 @@
+import hashlib
+import json
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+# per-feature mean/std of the observed values in one streaming pass (Welford,
+# merged chunk by chunk) with arbitrary exclusions: months for pm25, patients
+# for physio, time ranges for forecasting. Results are cached on disk under
+# data/normalizers/, keyed by the hash of the source files and the exclusion
+# set, so per-fold normalizers are read back without touching the raw data.
+# The file hashes are kept with the size/mtime stamp of each file and only
+# recomputed when the stamp changes.
+
+
+def file_hash(path, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class Welford:
+    def __init__(self, dim):
+        self.count = np.zeros(dim)
+        self.mean = np.zeros(dim)
+        self.m2 = np.zeros(dim)
+
+    def update(self, values, mask=None):
+        # values (n,K); mask (n,K) of the observed entries (default: not NaN)
+        values = np.asarray(values, dtype=np.float64)
+        if mask is None:
+            mask = ~np.isnan(values)
+        mask = np.asarray(mask, dtype=bool)
+        values = np.where(mask, values, 0.0)
+        count = mask.sum(0)
+        mean = values.sum(0) / np.maximum(count, 1)
+        m2 = (((values - mean) * mask) ** 2).sum(0)
+
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta * count / np.maximum(total, 1)
+        self.m2 = self.m2 + m2 + delta ** 2 * self.count * count / np.maximum(total, 1)
+        self.count = total
+
+    def finalize(self, ddof=0):
+        return self.mean, np.sqrt(self.m2 / (self.count - ddof))
+
+
+def get_file_hash(path, root):
+    # file_hash(path), read from root/file_hashes.json while the size and
+    # mtime of the file are unchanged
+    stat = os.stat(path)
+    stamp = [stat.st_size, stat.st_mtime_ns]
+    index_path = os.path.join(root, "file_hashes.json")
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path, "r") as f:
+            index = json.load(f)
+    key = os.path.abspath(path)
+    if key not in index or index[key]["stamp"] != stamp:
+        index[key] = {"stamp": stamp, "sha256": file_hash(path)}
+        os.makedirs(root, exist_ok=True)
+        tmp_path = index_path + "." + str(os.getpid()) + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, index_path)
+    return index[key]["sha256"]
+
+
+def get_cached(name, paths, exclude, compute, root="./data/normalizers"):
+    # [mean, std] from root/<name>_<key>.pk, computed once per key
+    h = hashlib.sha256()
+    for path in paths:
+        h.update(get_file_hash(path, root).encode())
+    h.update(json.dumps(sorted(exclude)).encode())
+    path = os.path.join(root, name + "_" + h.hexdigest()[:16] + ".pk")
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    mean, std = compute()
+    os.makedirs(root, exist_ok=True)
+    tmp_path = path + "." + str(os.getpid()) + ".tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump([mean, std], f)
+    os.replace(tmp_path, path)
+    return mean, std
+
+
+def get_pm25_normalizer(
+    folder="./data/pm25", exclude_months=(3, 6, 9, 12), chunk_size=2000
+):
+    # stations of pm25_ground.txt without the (test) months; sample std, as
+    # pandas' describe()
+    path = folder + "/Code/STMVL/SampleData/pm25_ground.txt"
+    exclude = [int(m) for m in exclude_months]
+
+    def compute():
+        stats = None
+        for df in pd.read_csv(
+            path, index_col="datetime", parse_dates=True, chunksize=chunk_size
+        ):
+            df = df[~df.index.month.isin(exclude)]
+            if stats is None:
+                stats = Welford(df.shape[1])
+            stats.update(df.values)
+        return stats.finalize(ddof=1)
+
+    return get_cached("pm25", [path], exclude, compute)
+
+
+def get_physio_normalizer(folder, exclude_patients=(), chunk_size=512):
+    # attributes of the physio_cache arrays in folder without the given patient
+    # indices (e.g. the test fold)
+    values_path = os.path.join(folder, "observed_values.npy")
+    masks_path = os.path.join(folder, "observed_masks.npy")
+    exclude = [int(i) for i in exclude_patients]
+
+    def compute():
+        values = np.load(values_path, mmap_mode="r")
+        masks = np.load(masks_path, mmap_mode="r")
+        keep = np.ones(len(values), dtype=bool)
+        keep[exclude] = False
+        stats = Welford(values.shape[-1])
+        for start in range(0, len(values), chunk_size):
+            chunk = slice(start, start + chunk_size)
+            k = keep[chunk]
+            stats.update(
+                values[chunk][k].reshape(-1, values.shape[-1]),
+                masks[chunk][k].reshape(-1, values.shape[-1]),
+            )
+        return stats.finalize(ddof=0)
+
+    return get_cached("physio", [values_path, masks_path], exclude, compute)
+
+
+def get_forecasting_normalizer(datafolder, exclude_ranges=(), chunk_size=4096):
+    # series of datafolder/data.pkl (main_data, mask_data; (T,K)) without the
+    # given [start, stop) time ranges (e.g. the validation and test parts)
+    path = datafolder + "/data.pkl"
+    exclude = [[int(start), int(stop)] for start, stop in exclude_ranges]
+
+    def compute():
+        with open(path, "rb") as f:
+            main_data, mask_data = pickle.load(f)
+        keep = np.ones(len(main_data), dtype=bool)
+        for start, stop in exclude:
+            keep[start:stop] = False
+        stats = Welford(main_data.shape[1])
+        for start in range(0, len(main_data), chunk_size):
+            chunk = slice(start, start + chunk_size)
+            k = keep[chunk]
+            stats.update(main_data[chunk][k], mask_data[chunk][k])
+        return stats.finalize(ddof=0)
+
+    return get_cached("forecasting", [path], exclude, compute)
@@ -0,0 +1,300 @@
+import glob
+import hashlib
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from torch.utils.data import DataLoader, Dataset
+
+from bucketing import BucketBatchSampler, get_effective_lengths, report_tokens, trim_collate
+from mask_generator import MaskedLoader
+from normalizer import Welford, file_hash, get_physio_normalizer
+
+# PhysioNet 2012 (set-a) parsed once into fixed-layout .npy arrays:
+#   data/physio_cache/<content hash>/observed_values.npy  (N,48,35) float32
+#   data/physio_cache/<content hash>/observed_masks.npy   (N,48,35) bool
+#   data/physio_cache/<content hash>/timepoints.npy       (N,48) float32
+#   data/physio_cache/<content hash>/gt_masks_missing{ratio}_seed{seed}.npy
+#   data/physio_cache/<content hash>/folds/seed{seed}_fold{nfold}.npz
+# plus index.json (patient ids, attributes, mean/std). Every patient file is
+# parsed into data/physio_cache/patients/<file hash>.npy, so a rebuild only
+# parses new or changed patients, and the arrays are keyed on the hashes of
+# all patient files. current.json points at the cache of the last build with
+# the size and mtime of set-a.tar.gz, which is only hashed when it changes.
+# Datasets open the arrays memory-mapped and fold splits are index files into
+# them.
+
+attributes = ['DiasABP', 'HR', 'Na', 'Lactate', 'NIDiasABP', 'PaO2', 'WBC', 'pH', 'Albumin', 'ALT', 'Glucose', 'SaO2',
+              'Temp', 'AST', 'Bilirubin', 'HCO3', 'BUN', 'RespRate', 'Mg', 'HCT', 'SysABP', 'FiO2', 'K', 'GCS',
+              'Cholesterol', 'NISysABP', 'TroponinT', 'MAP', 'TroponinI', 'PaCO2', 'Platelets', 'Urine', 'NIMAP',
+              'Creatinine', 'ALP']
+
+NUM_HOURS = 48
+
+
+def atomic_save(path, array):
+    # ranks launched together may build the same cache; each writes its own
+    # temporary file and the last rename wins
+    tmp_path = path + "." + str(os.getpid()) + ".tmp.npy"
+    np.save(tmp_path, array)
+    os.replace(tmp_path, path)
+
+
+def parse_patient(path):
+    # (48,35) values per hour; the last measurement of an hour is kept
+    attr_index = {attr: i for i, attr in enumerate(attributes)}
+    values = np.full((NUM_HOURS, len(attributes)), np.nan, dtype=np.float32)
+    with open(path, "r") as f:
+        next(f)  # Time,Parameter,Value
+        for line in f:
+            time, param, value = line.strip().split(",")
+            hour = int(time.split(":")[0])
+            if param in attr_index and hour < NUM_HOURS:
+                values[hour, attr_index[param]] = float(value)
+    return values
+
+
+def get_archive_stamp(archive):
+    stat = os.stat(archive)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def write_json(path, obj):
+    tmp_path = path + "." + str(os.getpid()) + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(obj, f)
+    os.replace(tmp_path, path)
+
+
+def build_cache(
+    archive="./data/set-a.tar.gz",
+    source="./data/physio/set-a",
+    root="./data/physio_cache",
+    num_workers=None,
+):
+    paths = sorted(glob.glob(os.path.join(source, "*.txt")))
+    patient_ids = [int(re.search(r"\d{6}", os.path.basename(p)).group()) for p in paths]
+    hashes = [file_hash(path) for path in paths]
+    key = hashlib.sha256(json.dumps([patient_ids, hashes]).encode()).hexdigest()
+    folder = os.path.join(root, key[:16])
+
+    if not os.path.exists(os.path.join(folder, "index.json")):
+        patient_folder = os.path.join(root, "patients")
+        os.makedirs(patient_folder, exist_ok=True)
+        patient_paths = [os.path.join(patient_folder, h + ".npy") for h in hashes]
+        missing = [i for i, path in enumerate(patient_paths) if not os.path.exists(path)]
+        print("parsing", len(missing), "of", len(paths), "patients")
+        with ProcessPoolExecutor(max_workers=num_workers) as pool:
+            parsed = pool.map(parse_patient, [paths[i] for i in missing], chunksize=64)
+            for i, values in zip(missing, parsed):
+                atomic_save(patient_paths[i], values)
+
+        os.makedirs(folder, exist_ok=True)
+        observed_values = np.stack([np.load(path) for path in patient_paths])
+        observed_masks = ~np.isnan(observed_values)
+        observed_values = np.nan_to_num(observed_values)
+        timepoints = np.tile(np.arange(NUM_HOURS, dtype=np.float32), (len(paths), 1))
+
+        stats = Welford(len(attributes))
+        stats.update(
+            observed_values.reshape(-1, len(attributes)),
+            observed_masks.reshape(-1, len(attributes)),
+        )
+        mean, std = stats.finalize()
+
+        atomic_save(os.path.join(folder, "observed_values.npy"), observed_values)
+        atomic_save(os.path.join(folder, "observed_masks.npy"), observed_masks)
+        atomic_save(os.path.join(folder, "timepoints.npy"), timepoints)
+        # index.json is written last and marks the cache as complete
+        write_json(
+            os.path.join(folder, "index.json"),
+            {
+                "patient_ids": patient_ids,
+                "attributes": attributes,
+                "mean": mean.tolist(),
+                "std": std.tolist(),
+            },
+        )
+
+    current = {"folder": key[:16]}
+    if os.path.exists(archive):
+        current.update(get_archive_stamp(archive), archive_sha256=file_hash(archive))
+    write_json(os.path.join(root, "current.json"), current)
+    return folder
+
+
+def get_cache_folder(
+    archive="./data/set-a.tar.gz",
+    source="./data/physio/set-a",
+    root="./data/physio_cache",
+):
+    # the cache of the last build while set-a.tar.gz keeps its size and mtime,
+    # without hashing anything; otherwise an (incremental) rebuild
+    current_path = os.path.join(root, "current.json")
+    if os.path.exists(current_path):
+        with open(current_path, "r") as f:
+            current = json.load(f)
+        folder = os.path.join(root, current["folder"])
+        stamp = get_archive_stamp(archive) if os.path.exists(archive) else {}
+        if all(current.get(k) == v for k, v in stamp.items()) and os.path.exists(
+            os.path.join(folder, "index.json")
+        ):
+            return folder
+    return build_cache(archive, source, root)
+
+
+def get_gt_masks_path(folder, missing_ratio, seed):
+    name = "gt_masks_missing" + str(missing_ratio) + "_seed" + str(seed) + ".npy"
+    return os.path.join(folder, name)
+
+
+def build_gt_masks(folder, missing_ratio=0.1, seed=0):
+    # randomly hide missing_ratio of the observed values of every patient as
+    # ground truth; one generator per patient, so the result is independent of
+    # the order the patients are processed in
+    path = get_gt_masks_path(folder, missing_ratio, seed)
+    if os.path.exists(path):
+        return path
+    with open(os.path.join(folder, "index.json"), "r") as f:
+        patient_ids = json.load(f)["patient_ids"]
+    observed_masks = np.load(os.path.join(folder, "observed_masks.npy"), mmap_mode="r")
+    gt_masks = np.array(observed_masks)
+    for i, patient_id in enumerate(patient_ids):
+        masks = gt_masks[i].reshape(-1)
+        obs_indices = np.where(masks)[0]
+        rng = np.random.RandomState([seed, patient_id])
+        miss_indices = rng.choice(
+            obs_indices, int(len(obs_indices) * missing_ratio), replace=False
+        )
+        masks[miss_indices] = False
+    atomic_save(path, gt_masks)
+    return path
+
+
+def build_fold(folder, seed=0, nfold=0):
+    # train/valid/test indices of one 5-fold split
+    path = os.path.join(
+        folder, "folds", "seed" + str(seed) + "_fold" + str(nfold) + ".npz"
+    )
+    if os.path.exists(path):
+        return path
+    with open(os.path.join(folder, "index.json"), "r") as f:
+        num_patients = len(json.load(f)["patient_ids"])
+    indlist = np.arange(num_patients)
+    np.random.seed(seed)
+    np.random.shuffle(indlist)
+    start = int(nfold * 0.2 * num_patients)
+    end = int((nfold + 1) * 0.2 * num_patients)
+    test_index = indlist[start:end]
+    remain_index = np.delete(indlist, np.arange(start, end))
+    np.random.seed(seed)
+    np.random.shuffle(remain_index)
+    num_train = int(num_patients * 0.7)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + "." + str(os.getpid()) + ".tmp.npz"
+    np.savez(
+        tmp_path,
+        train=remain_index[:num_train],
+        valid=remain_index[num_train:],
+        test=test_index,
+    )
+    os.replace(tmp_path, path)
+    return path
+
+
+class Physio_Cache_Dataset(Dataset):
+    def __init__(self, folder, indices, missing_ratio=0.1, seed=0, normalizer=None):
+        # normalizer: (mean, std), by default those of all patients
+        if normalizer is None:
+            with open(os.path.join(folder, "index.json"), "r") as f:
+                index = json.load(f)
+            normalizer = (index["mean"], index["std"])
+        self.mean = np.array(normalizer[0], dtype=np.float32)
+        self.std = np.array(normalizer[1], dtype=np.float32)
+        self.observed_values = np.load(
+            os.path.join(folder, "observed_values.npy"), mmap_mode="r"
+        )
+        self.observed_masks = np.load(
+            os.path.join(folder, "observed_masks.npy"), mmap_mode="r"
+        )
+        self.gt_masks = None  # drawn per batch by a MaskedLoader
+        if missing_ratio is not None:
+            self.gt_masks = np.load(
+                get_gt_masks_path(folder, missing_ratio, seed), mmap_mode="r"
+            )
+        self.timepoints = np.load(os.path.join(folder, "timepoints.npy"), mmap_mode="r")
+        self.indices = indices
+
+    def __getitem__(self, org_index):
+        index = self.indices[org_index]
+        observed_mask = self.observed_masks[index].astype(np.float32)
+        observed_data = (self.observed_values[index] - self.mean) / self.std
+        s = {
+            "observed_data": observed_data * observed_mask,
+            "observed_mask": observed_mask,
+            "timepoints": np.array(self.timepoints[index]),
+        }
+        if self.gt_masks is not None:
+            s["gt_mask"] = self.gt_masks[index].astype(np.float32)
+        return s
+
+    def __len__(self):
+        return len(self.indices)
+
+
+def get_dataloader(
+    seed=1,
+    nfold=0,
+    batch_size=16,
+    missing_ratio=0.1,
+    root="./data/physio_cache",
+    online_masks=False,
+    device=None,
+    fold_normalizer=False,
+    bucketing=False,
+):
+    # online_masks: the datasets ship raw observations and the ground-truth
+    # masks are drawn per batch (on device, if given) by mask_generator.
+    # fold_normalizer: mean/std without the test patients of the fold.
+    # bucketing: batches of patients with similar stay length, padded to the
+    # longest of the batch instead of 48 hours
+    folder = get_cache_folder(root=root)
+    folds = np.load(build_fold(folder, seed, nfold))
+    normalizer = None
+    if fold_normalizer:
+        normalizer = get_physio_normalizer(folder, exclude_patients=folds["test"])
+    dataset_ratio = None
+    if not online_masks:
+        build_gt_masks(folder, missing_ratio, seed)
+        dataset_ratio = missing_ratio
+
+    if bucketing:
+        lengths = get_effective_lengths(
+            np.load(os.path.join(folder, "observed_masks.npy"), mmap_mode="r")
+        )
+
+    loaders = []
+    for split in ["train", "valid", "test"]:
+        dataset = Physio_Cache_Dataset(
+            folder, folds[split], dataset_ratio, seed, normalizer
+        )
+        if bucketing:
+            batch_sampler = BucketBatchSampler(
+                lengths[folds[split]], batch_size, shuffle=split == "train", seed=seed
+            )
+            loader = DataLoader(
+                dataset, batch_sampler=batch_sampler, collate_fn=trim_collate
+            )
+            tokens = report_tokens(batch_sampler, NUM_HOURS, len(attributes))
+            print(split, "tokens per epoch:", tokens)
+        else:
+            loader = DataLoader(dataset, batch_size=batch_size, shuffle=split == "train")
+        if online_masks:
+            loader = MaskedLoader(
+                loader, missing_ratio, seed, per_epoch=split == "train", device=device
+            )
+        loaders.append(loader)
+    train_loader, valid_loader, test_loader = loaders
+    return train_loader, valid_loader, test_loader
@@ -0,0 +1,184 @@
+import queue
+import threading
+
+import torch
+from torch.utils.data import RandomSampler
+from torch.utils.data._utils.collate import default_collate
+
+
+def to_device(batch, device, non_blocking=False):
+    if torch.is_tensor(batch):
+        return batch.to(device, non_blocking=non_blocking)
+    if isinstance(batch, dict):
+        return {key: to_device(value, device, non_blocking) for key, value in batch.items()}
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(to_device(value, device, non_blocking) for value in batch)
+    return batch
+
+
+def pin(batch):
+    if torch.is_tensor(batch):
+        return batch.pin_memory()
+    if isinstance(batch, dict):
+        return {key: pin(value) for key, value in batch.items()}
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(pin(value) for value in batch)
+    return batch
+
+
+def _record_stream(batch, stream):
+    if torch.is_tensor(batch):
+        batch.record_stream(stream)
+    elif isinstance(batch, dict):
+        for value in batch.values():
+            _record_stream(value, stream)
+    elif isinstance(batch, (list, tuple)):
+        for value in batch:
+            _record_stream(value, stream)
+
+
+class PrefetchLoader:
+    # wraps a loader: a background thread takes the next num_prefetch batches,
+    # pins them and copies them to device with non_blocking copies on a side
+    # CUDA stream, so loading and the host-to-device copy overlap the training
+    # step. On cpu only the loading overlaps
+    def __init__(self, loader, device, num_prefetch=2):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.num_prefetch = num_prefetch
+
+    def with_loader(self, loader):
+        return PrefetchLoader(loader, self.device, self.num_prefetch)
+
+    def _put(self, batches, item, stop):
+        # gives up once the consumer has stopped, so the thread can be joined
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce(self, batches, stop):
+        cuda = self.device.type == "cuda"
+        stream = torch.cuda.Stream(self.device) if cuda else None
+        try:
+            for batch in self.loader:
+                if cuda:
+                    batch = pin(batch)
+                    with torch.cuda.stream(stream):
+                        batch = to_device(batch, self.device, non_blocking=True)
+                        event = torch.cuda.Event()
+                        event.record(stream)
+                else:
+                    batch, event = to_device(batch, self.device), None
+                if not self._put(batches, (batch, event), stop):
+                    return
+            self._put(batches, None, stop)
+        except Exception as e:
+            self._put(batches, e, stop)
+
+    def __iter__(self):
+        batches = queue.Queue(maxsize=self.num_prefetch)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(batches, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = batches.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                batch, event = item
+                if event is not None:
+                    current = torch.cuda.current_stream(self.device)
+                    current.wait_event(event)
+                    _record_stream(batch, current)
+                yield batch
+        finally:
+            # also reached when the consumer stops early (itr_per_epoch)
+            stop.set()
+            thread.join()
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        # sampler, batch_sampler, dataset, ... of the wrapped loader
+        return getattr(self.__dict__["loader"], name)
+
+
+class DeviceResidentLoader:
+    # the whole (small, fixed-shape) dataset collated once and kept on device;
+    # batches are index_select-ed there, shuffled per epoch with a seeded
+    # generator, so no per-step loading or copying remains. Sharded shuffled
+    # loaders pad the order with repeated items, as DistributedSampler, so every
+    # rank runs the same number of batches; ordered ones stay an exact split
+    def __init__(
+        self,
+        data,
+        batch_size,
+        shuffle=False,
+        seed=0,
+        num_replicas=1,
+        rank=0,
+        dataset=None,
+    ):
+        self.data = data
+        self.dataset = dataset  # the source dataset, for its attributes
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self.num_items = len(next(v for v in data.values() if torch.is_tensor(v)))
+
+    @classmethod
+    def from_loader(cls, loader, device, seed=0):
+        if hasattr(loader, "with_loader"):
+            # keep wrappers (e.g. MaskedLoader) around the resident loader
+            return loader.with_loader(cls.from_loader(loader.loader, device, seed))
+        if loader.batch_size is None:
+            raise ValueError("a device-resident loader needs a fixed batch size")
+        dataset = loader.dataset
+        data = to_device(default_collate([dataset[i] for i in range(len(dataset))]), device)
+        shuffle = isinstance(loader.sampler, RandomSampler)
+        return cls(data, loader.batch_size, shuffle, seed, dataset=dataset)
+
+    def shard(self, rank, num_replicas):
+        return DeviceResidentLoader(
+            self.data,
+            self.batch_size,
+            self.shuffle,
+            self.seed,
+            num_replicas,
+            rank,
+            self.dataset,
+        )
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def indices(self):
+        device = next(v for v in self.data.values() if torch.is_tensor(v)).device
+        if self.shuffle:
+            generator = torch.Generator().manual_seed(self.seed + self.epoch)
+            order = torch.randperm(self.num_items, generator=generator)
+            total = -(-self.num_items // self.num_replicas) * self.num_replicas
+            order = order.repeat(-(-total // self.num_items))[:total]
+        else:
+            order = torch.arange(self.num_items)
+        return order[self.rank :: self.num_replicas].to(device)
+
+    def __iter__(self):
+        for index in self.indices().split(self.batch_size):
+            yield {
+                key: value.index_select(0, index) if torch.is_tensor(value) else value
+                for key, value in self.data.items()
+            }
+
+    def __len__(self):
+        return -(-len(self.indices()) // self.batch_size)
@@ -0,0 +1,91 @@
+import bisect
+import json
+import os
+
+import numpy as np
+import torch
+
+# one .npy shard per field and per evaluated batch, plus index.json with the
+# row range of every shard; rows are series, so the reader can memory-map a
+# shard and slice a single series/feature without loading the whole output
+FIELDS = ["samples", "target", "eval_points", "observed_points", "observed_time"]
+
+
+def _shard_path(folder, name, shard_no):
+    return os.path.join(folder, name + "_" + str(shard_no).zfill(5) + ".npy")
+
+
+def _to_numpy(x):
+    return torch.as_tensor(x).detach().cpu().numpy()
+
+
+class SampleWriter:
+    def __init__(self, folder, scaler=1, mean_scaler=0):
+        self.folder = folder
+        self.shards = []
+        self.nrows = 0
+        os.makedirs(folder, exist_ok=True)
+        np.save(os.path.join(folder, "scaler.npy"), _to_numpy(scaler))
+        np.save(os.path.join(folder, "mean_scaler.npy"), _to_numpy(mean_scaler))
+
+    def write(self, samples, target, eval_points, observed_points, observed_time):
+        # samples: (B,nsample,L,K), target/eval_points/observed_points: (B,L,K)
+        shard_no = len(self.shards)
+        arrays = [samples, target, eval_points, observed_points, observed_time]
+        for name, x in zip(FIELDS, arrays):
+            np.save(_shard_path(self.folder, name, shard_no), _to_numpy(x))
+        batch_size = len(target)
+        self.shards.append([self.nrows, self.nrows + batch_size])
+        self.nrows += batch_size
+
+    def close(self):
+        index = {"fields": FIELDS, "shards": self.shards, "nrows": self.nrows}
+        tmp_path = os.path.join(self.folder, "index.json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, os.path.join(self.folder, "index.json"))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class SampleReader:
+    def __init__(self, folder):
+        self.folder = folder
+        with open(os.path.join(folder, "index.json"), "r") as f:
+            index = json.load(f)
+        self.shards = index["shards"]
+        self.starts = [start for start, _ in self.shards]
+        self.nrows = index["nrows"]
+        self.scaler = np.load(os.path.join(folder, "scaler.npy"))
+        self.mean_scaler = np.load(os.path.join(folder, "mean_scaler.npy"))
+        self._mmaps = {}
+
+    def __len__(self):
+        return self.nrows
+
+    def shard(self, name, shard_no):
+        key = (name, shard_no)
+        if key not in self._mmaps:
+            path = _shard_path(self.folder, name, shard_no)
+            self._mmaps[key] = np.load(path, mmap_mode="r")
+        return self._mmaps[key]
+
+    def get(self, name, index):
+        # memory-mapped view of one series; slicing it further (e.g. [..., k])
+        # only touches the pages that are actually read
+        if index < 0:
+            index += self.nrows
+        if not 0 <= index < self.nrows:
+            raise IndexError("series index out of range")
+        shard_no = bisect.bisect_right(self.starts, index) - 1
+        return self.shard(name, shard_no)[index - self.starts[shard_no]]
+
+    def load(self, name):
+        # full array for a field; reads every shard
+        return np.concatenate(
+            [self.shard(name, i) for i in range(len(self.shards))], axis=0
+        )
@@ -0,0 +1,107 @@
+import torch
+import torch.nn as nn
+
+# attention over the active (observed or targeted) tokens of each sequence
+# only. The layers are the same nn.TransformerEncoder as get_torch_trans in
+# diff_models, so checkpoints load either way; what changes is which tokens a
+# sequence attends over. Inactive tokens are neither queries nor keys and are
+# passed through unchanged.
+#
+# "packed": active tokens are moved to the front of their sequence and the
+#   sequences are sorted by active count and cut into buckets, each run at its
+#   own longest active length (a padded segment layout), so the cost follows
+#   sum(n_active^2) instead of N * S^2.
+# "masked": dense fallback over all S tokens with a key padding mask; same
+#   result, dense cost.
+#
+# In the CSDI residual block the sequences are (B*K,C,L) for the time layer
+# and (B*L,C,K) for the feature layer; time_tokens / feature_tokens give the
+# matching (N,S) active masks from a (B,K,L) mask.
+
+
+def get_sparse_trans(heads=8, layers=1, channels=64, mode="packed", num_buckets=4):
+    return SparseTransformer(heads, layers, channels, mode, num_buckets)
+
+
+def time_tokens(active):
+    B, K, L = active.shape
+    return active.reshape(B * K, L)
+
+
+def feature_tokens(active):
+    B, K, L = active.shape
+    return active.permute(0, 2, 1).reshape(B * L, K)
+
+
+class SparseTransformer(nn.Module):
+    def __init__(self, heads=8, layers=1, channels=64, mode="packed", num_buckets=4):
+        super().__init__()
+        if mode not in ["packed", "masked"]:
+            raise ValueError("unknown sparse attention mode: " + str(mode))
+        encoder_layer = nn.TransformerEncoderLayer(
+            d_model=channels, nhead=heads, dim_feedforward=64, activation="gelu"
+        )
+        self.layer = nn.TransformerEncoder(encoder_layer, num_layers=layers)
+        self.mode = mode
+        self.num_buckets = num_buckets
+
+    def forward(self, x, active):
+        # x: (N,C,S) as in the residual block, active: (N,S) bool
+        active = active.bool()
+        if self.mode == "masked":
+            return self.forward_masked(x, active)
+        return self.forward_packed(x, active)
+
+    def forward_masked(self, x, active):
+        # rows without any active token are skipped (a fully masked row has no
+        # softmax); inactive tokens keep their input
+        rows = active.any(1)
+        out = x.clone()
+        if rows.any():
+            y = self.layer(
+                x[rows].permute(2, 0, 1), src_key_padding_mask=~active[rows]
+            ).permute(1, 2, 0)
+            out[rows] = torch.where(active[rows].unsqueeze(1), y, x[rows])
+        return out
+
+    def forward_packed(self, x, active):
+        N, C, S = x.shape
+        counts = active.sum(1)
+        # stable sort puts the active tokens first, in their original order
+        order = (~active).to(torch.int8).argsort(dim=1, stable=True)  # (N,S)
+        packed = x.gather(2, order.unsqueeze(1).expand(-1, C, -1))  # (N,C,S)
+
+        out = x.clone()
+        rows_by_count = counts.argsort(descending=True)
+        rows_by_count = rows_by_count[counts[rows_by_count] > 0]
+        for rows in rows_by_count.tensor_split(self.num_buckets):
+            if len(rows) == 0:
+                continue
+            n = int(counts[rows[0]])  # longest in the bucket
+            tokens = packed[rows, :, :n].permute(2, 0, 1)  # (n,rows,C)
+            padding = torch.arange(n, device=x.device) >= counts[rows].unsqueeze(1)
+            y = self.layer(tokens, src_key_padding_mask=padding).permute(1, 2, 0)
+            # scatter the active outputs back to their positions
+            index = order[rows, :n]
+            y = torch.where(padding.unsqueeze(1), packed[rows, :, :n], y)
+            bucket = out[rows]
+            bucket.scatter_(2, index.unsqueeze(1).expand(-1, C, -1), y)
+            out[rows] = bucket
+        return out
+
+
+def count_flops(active, channels=64, dim_feedforward=64, layers=1):
+    # multiply-adds of the encoder layers over the given (N,S) active masks:
+    # dense (every sequence at full S) and sparse (active tokens only)
+    def flops(n):
+        projections = 4 * n * channels * channels  # q, k, v, out
+        attention = 2 * n * n * channels  # scores and weighted sum
+        feedforward = 2 * n * channels * dim_feedforward
+        return layers * (projections + attention + feedforward)
+
+    N, S = active.shape
+    counts = active.sum(1).double()
+    return {
+        "dense": N * flops(torch.tensor(float(S))).item(),
+        "sparse": flops(counts).sum().item(),
+    }
@@ -1,9 +1,156 @@
+import contextlib
+import itertools
+import json
+import os
+import time
+
 import numpy as np
 import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
 from torch.optim import Adam
+from torch.utils.data import DataLoader, DistributedSampler, RandomSampler, Sampler
 from tqdm import tqdm
 import pickle
 
+import instrument
+from checkpoint import Checkpointer, get_rng_state, set_rng_state
+from ema import EMA
+from prefetch import DeviceResidentLoader, PrefetchLoader
+from sample_store import SampleWriter
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def init_distributed(backend="gloo"):
+    # one process per rank, started by torchrun (RANK, WORLD_SIZE, MASTER_ADDR,
+    # MASTER_PORT and LOCAL_RANK come from the environment); gloo runs on cpu.
+    # nccl runs object collectives on the current device, so every rank is
+    # pinned to its own GPU first
+    if backend == "nccl":
+        torch.cuda.set_device(int(os.environ["LOCAL_RANK"]))
+    dist.init_process_group(backend=backend)
+    return dist.get_rank(), dist.get_world_size()
+
+
+def broadcast_object(obj):
+    # value of rank 0 on every rank (e.g. the timestamped output folder)
+    if not is_distributed():
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=0)
+    return objects[0]
+
+
+def shard_loader(loader):
+    # same loader restricted to this rank's share of the dataset: shuffled
+    # loaders get a DistributedSampler (reshuffled per epoch in train), ordered
+    # ones a strided split without padding so summed metrics stay exact
+    if not is_distributed():
+        return loader
+    if hasattr(loader, "with_loader"):
+        # wrappers (MaskedLoader, PrefetchLoader) around the sharded loader
+        return loader.with_loader(shard_loader(loader.loader))
+    if hasattr(loader, "shard"):
+        return loader.shard(get_rank(), dist.get_world_size())
+    if hasattr(loader.batch_sampler, "shard"):
+        # batch samplers that shard themselves (bucketing.BucketBatchSampler)
+        return DataLoader(
+            loader.dataset,
+            batch_sampler=loader.batch_sampler.shard(
+                get_rank(), dist.get_world_size()
+            ),
+            num_workers=loader.num_workers,
+            collate_fn=loader.collate_fn,
+            pin_memory=loader.pin_memory,
+        )
+    if isinstance(loader.sampler, RandomSampler):
+        sampler = DistributedSampler(loader.dataset, shuffle=True)
+    else:
+        sampler = range(get_rank(), len(loader.dataset), dist.get_world_size())
+    return DataLoader(
+        loader.dataset,
+        batch_size=loader.batch_size,
+        sampler=sampler,
+        num_workers=loader.num_workers,
+        collate_fn=loader.collate_fn,
+        pin_memory=loader.pin_memory,
+        drop_last=loader.drop_last,
+    )
+
+
+class StridedBatchSampler(Sampler):
+    # every num_replicas-th batch of batch_sampler from rank on, in order and
+    # without padding; batch_numbers() are their 1-based positions in the full
+    # batch_sampler
+    def __init__(self, batch_sampler, rank, num_replicas):
+        self.batch_sampler = batch_sampler
+        self.rank = rank
+        self.num_replicas = num_replicas
+
+    def batch_numbers(self):
+        return range(self.rank + 1, len(self.batch_sampler) + 1, self.num_replicas)
+
+    def __iter__(self):
+        return itertools.islice(self.batch_sampler, self.rank, None, self.num_replicas)
+
+    def __len__(self):
+        return len(self.batch_numbers())
+
+
+class StridedBatches(StridedBatchSampler):
+    # the same over the batches of loaders without a batch sampler (lists of
+    # batches, DeviceResidentLoader, where a skipped batch is not loaded)
+    def __getattr__(self, name):
+        return getattr(self.__dict__["batch_sampler"], name)
+
+
+def shard_batches(loader, rank, num_replicas):
+    # this rank's batches of an ordered loader for sharded evaluation: only
+    # these are loaded, collated and masked, and get_batch_numbers gives their
+    # positions in the full loader (per-batch seeds, merge order)
+    if hasattr(loader, "with_loader"):
+        return loader.with_loader(shard_batches(loader.loader, rank, num_replicas))
+    if isinstance(loader, DataLoader) and loader.batch_sampler is not None:
+        return DataLoader(
+            loader.dataset,
+            batch_sampler=StridedBatchSampler(loader.batch_sampler, rank, num_replicas),
+            num_workers=loader.num_workers,
+            collate_fn=loader.collate_fn,
+            pin_memory=loader.pin_memory,
+        )
+    return StridedBatches(loader, rank, num_replicas)
+
+
+def get_batch_numbers(loader):
+    # 1-based positions of the batches of loader in the unsharded loader
+    for source in [loader, getattr(loader, "batch_sampler", None)]:
+        if hasattr(source, "batch_numbers"):
+            return source.batch_numbers()
+    return range(1, len(loader) + 1)
+
+
+def prepare_loader(loader, device, prefetch=False, resident=False, shard=True):
+    # resident: whole dataset collated once on device (fixed-shape datasets);
+    # prefetch: batches loaded and copied to device on a background thread
+    if resident:
+        loader = DeviceResidentLoader.from_loader(loader, device)
+    if shard:
+        loader = shard_loader(loader)
+    if prefetch and not resident:
+        loader = PrefetchLoader(loader, device)
+    return loader
+
 
 def train(
     model,
@@ -12,7 +159,11 @@ def train(
     valid_loader=None,
     valid_epoch_interval=20,
     foldername="",
+    resume=False,
+    loss_model=None,
 ):
+    # loss_model(batch, is_train) computes the losses in place of model (e.g.
+    # diffusion_loss.MultistepLoss); it must hold model's parameters
     optimizer = Adam(model.parameters(), lr=config["lr"], weight_decay=1e-6)
     if foldername != "":
         output_path = foldername + "/model.pth"
@@ -23,21 +174,112 @@ def train(
         optimizer, milestones=[p1, p2], gamma=0.1
     )
 
+    # optional mixed precision (fp16 + grad scaler on cuda, bf16 on cpu) and
+    # gradient accumulation up to config["effective_batch_size"]
+    effective_batch_size = config.get("effective_batch_size", config["batch_size"])
+    accum_steps = max(1, effective_batch_size // config["batch_size"])
+    device = next(model.parameters()).device
+    device_type = device.type
+    amp_dtype = torch.float16 if device_type == "cuda" else torch.bfloat16
+    use_amp = config.get("amp", False)
+    scaler = torch.amp.GradScaler(
+        device_type, enabled=use_amp and amp_dtype == torch.float16
+    )
+
+    # exponential moving average of the weights when config["ema_decay"] > 0,
+    # used for validation and returned for evaluation
+    ema = None
+    if config.get("ema_decay", 0) > 0:
+        ema = EMA(model, config["ema_decay"])
+
+    train_log = []
     best_valid_loss = 1e10
-    for epoch_no in range(config["epochs"]):
+    start_epoch = 0
+
+    # full training state every config["checkpoint_interval"] epochs and on
+    # every new best validation loss, written in the background
+    checkpointer = None
+    if foldername != "":
+        checkpointer = Checkpointer(foldername, config.get("keep_checkpoints", 3))
+    checkpoint_interval = config.get("checkpoint_interval", config["epochs"])
+    if resume and checkpointer is not None and checkpointer.latest() is not None:
+        checkpoint = checkpointer.load(checkpointer.latest(), device)
+        model.load_state_dict(checkpoint["model"])
+        optimizer.load_state_dict(checkpoint["optimizer"])
+        lr_scheduler.load_state_dict(checkpoint["lr_scheduler"])
+        scaler.load_state_dict(checkpoint["scaler"])
+        if ema is not None and checkpoint.get("ema") is not None:
+            ema.load_state_dict(checkpoint["ema"])
+        elif ema is not None:
+            ema = EMA(model, config["ema_decay"])
+        set_rng_state(checkpoint["rng"])
+        best_valid_loss = checkpoint["best_valid_loss"]
+        train_log = checkpoint["train_log"]
+        start_epoch = checkpoint["epoch"] + 1
+        if is_main_process():
+            print("resumed from epoch", checkpoint["epoch"])
+
+    # under torch.distributed the model is wrapped in DDP; only rank 0 shows
+    # progress and writes files
+    net = model
+    loss_net = model if loss_model is None else loss_model
+    model = loss_net
+    if is_distributed():
+        model = DistributedDataParallel(
+            loss_net, device_ids=[device] if device_type == "cuda" else None
+        )
+    show_progress = is_main_process()
+
+    for epoch_no in range(start_epoch, config["epochs"]):
         avg_loss = 0
+        epoch_start = time.time()
+        # per-epoch shuffling of the loader itself or of its (batch) sampler
+        for sampler in [
+            train_loader,
+            getattr(train_loader, "sampler", None),
+            getattr(train_loader, "batch_sampler", None),
+        ]:
+            if hasattr(sampler, "set_epoch"):
+                sampler.set_epoch(epoch_no)
         model.train()
-        with tqdm(train_loader, mininterval=5.0, maxinterval=50.0) as it:
-            for batch_no, train_batch in enumerate(it, start=1):
-                optimizer.zero_grad()
-
-                loss = model(train_batch)
-                loss.backward()
+        optimizer.zero_grad()
+        with tqdm(
+            train_loader,
+            mininterval=5.0,
+            maxinterval=50.0,
+            disable=not show_progress,
+        ) as it:
+            for batch_no, train_batch in enumerate(instrument.timed_iter(it), start=1):
+                last_batch = (
+                    batch_no >= config["itr_per_epoch"]
+                    or batch_no == len(train_loader)
+                )
+                optimizer_step = batch_no % accum_steps == 0 or last_batch
+                # gradients are only all-reduced on the batch that steps
+                sync = contextlib.nullcontext()
+                if is_distributed() and not optimizer_step:
+                    sync = model.no_sync()
+                with sync:
+                    with instrument.timer("train_forward"), torch.autocast(
+                        device_type=device_type, dtype=amp_dtype, enabled=use_amp
+                    ):
+                        loss = model(train_batch)
+                    with instrument.timer("train_backward"):
+                        scaler.scale(loss / accum_steps).backward()
                 avg_loss += loss.item()
-                optimizer.step()
+                if optimizer_step:
+                    with instrument.timer("optimizer_step"):
+                        scaler.step(optimizer)
+                        scaler.update()
+                        optimizer.zero_grad()
+                        if ema is not None:
+                            ema.update()
+                instrument.count("train_batches")
+                instrument.step()
                 it.set_postfix(
                     ordered_dict={
                         "avg_epoch_loss": avg_loss / batch_no,
+                        "batches_per_sec": batch_no / (time.time() - epoch_start),
                         "epoch": epoch_no,
                     },
                     refresh=False,
@@ -46,13 +288,33 @@ def train(
                     break
 
             lr_scheduler.step()
+        epoch_time = time.time() - epoch_start
+        instrument.flush(phase="train", epoch=epoch_no)
+        train_log.append(
+            {
+                "epoch": epoch_no,
+                "avg_epoch_loss": avg_loss / batch_no,
+                "epoch_time": epoch_time,
+                "batches_per_sec": batch_no / epoch_time,
+            }
+        )
+        is_best = False
         if valid_loader is not None and (epoch_no + 1) % valid_epoch_interval == 0:
-            model.eval()
+            loss_net.eval()
             avg_loss_valid = 0
-            with torch.no_grad():
-                with tqdm(valid_loader, mininterval=5.0, maxinterval=50.0) as it:
-                    for batch_no, valid_batch in enumerate(it, start=1):
-                        loss = model(valid_batch, is_train=0)
+            batch_no = 0
+            with torch.no_grad(), ema.swap() if ema else contextlib.nullcontext():
+                with tqdm(
+                    valid_loader,
+                    mininterval=5.0,
+                    maxinterval=50.0,
+                    disable=not show_progress,
+                ) as it:
+                    for batch_no, valid_batch in enumerate(
+                        instrument.timed_iter(it), start=1
+                    ):
+                        with instrument.timer("valid_forward"):
+                            loss = loss_net(valid_batch, is_train=0)
                         avg_loss_valid += loss.item()
                         it.set_postfix(
                             ordered_dict={
@@ -61,17 +323,59 @@ def train(
                             },
                             refresh=False,
                         )
+            if is_distributed():
+                # loss sum and batch count over all ranks, so every rank agrees
+                # on the best loss
+                totals = torch.tensor(
+                    [avg_loss_valid, batch_no], dtype=torch.float64, device=device
+                )
+                dist.all_reduce(totals)
+                avg_loss_valid, batch_no = totals[0].item(), int(totals[1].item())
+            instrument.flush(phase="valid", epoch=epoch_no)
             if best_valid_loss > avg_loss_valid:
                 best_valid_loss = avg_loss_valid
-                print(
-                    "\n best loss is updated to ",
-                    avg_loss_valid / batch_no,
-                    "at",
-                    epoch_no,
-                )
+                is_best = True
+                if show_progress:
+                    print(
+                        "\n best loss is updated to ",
+                        avg_loss_valid / batch_no,
+                        "at",
+                        epoch_no,
+                    )
 
-    if foldername != "":
-        torch.save(model.state_dict(), output_path)
+        last_epoch = epoch_no + 1 == config["epochs"]
+        if checkpointer is not None and is_main_process():
+            if is_best or last_epoch or (epoch_no + 1) % checkpoint_interval == 0:
+                with instrument.timer("checkpoint_snapshot"):
+                    checkpointer.save(
+                        {
+                            "epoch": epoch_no,
+                            "model": net.state_dict(),
+                            "optimizer": optimizer.state_dict(),
+                            "lr_scheduler": lr_scheduler.state_dict(),
+                            "scaler": scaler.state_dict(),
+                            "rng": get_rng_state(),
+                            "best_valid_loss": best_valid_loss,
+                            "train_log": train_log,
+                            "ema": ema.state_dict() if ema is not None else None,
+                        },
+                        epoch_no,
+                        is_best=is_best,
+                    )
+
+    if checkpointer is not None and is_main_process():
+        checkpointer.wait()
+    if foldername != "" and is_main_process():
+        with instrument.timer("serialization"):
+            torch.save(net.state_dict(), output_path)
+        # per-epoch loss and time, for comparing runs (e.g. with and without amp)
+        with open(foldername + "/train_log.json", "w") as f:
+            json.dump(train_log, f, indent=4)
+        if ema is not None:
+            with ema.swap():
+                torch.save(net.state_dict(), foldername + "/model_ema.pth")
+    instrument.flush(phase="train_end")
+    return ema
 
 
 def quantile_loss(target, forecast, q: float, eval_points) -> float:
@@ -84,68 +388,182 @@ def calc_denominator(target, eval_points):
     return torch.sum(torch.abs(target * eval_points))
 
 
-def calc_quantile_CRPS(target, forecast, eval_points, mean_scaler, scaler):
+def calc_quantiles(forecast, quantiles, dim=1):
+    # same linear interpolation as torch.quantile, but one sort for all quantiles
+    # returns (len(quantiles), *forecast.shape without dim)
+    with instrument.timer("quantiles"):
+        sorted_forecast = forecast.sort(dim=dim).values
+        pos = torch.as_tensor(quantiles, dtype=forecast.dtype, device=forecast.device)
+        pos = pos * (sorted_forecast.shape[dim] - 1)
+        lower = pos.floor().long()
+        upper = pos.ceil().long()
+        lower_values = sorted_forecast.index_select(dim, lower).movedim(dim, 0)
+        upper_values = sorted_forecast.index_select(dim, upper).movedim(dim, 0)
+        weight = (pos - lower).view(-1, *([1] * (lower_values.dim() - 1)))
+        return lower_values + (upper_values - lower_values) * weight
 
-    target = target * scaler + mean_scaler
-    forecast = forecast * scaler + mean_scaler
 
-    quantiles = np.arange(0.05, 1.0, 0.05)
-    denom = calc_denominator(target, eval_points)
-    CRPS = 0
+def calc_quantile_losses(target, forecast, eval_points, quantiles):
+    # per-quantile loss sums for a (B,nsample,L,K) or (B,nsample,L) forecast
+    q_pred = calc_quantiles(forecast, quantiles, dim=1)
+    q_loss = forecast.new_zeros(len(quantiles))
     for i in range(len(quantiles)):
-        q_pred = []
-        for j in range(len(forecast)):
-            q_pred.append(torch.quantile(forecast[j : j + 1], quantiles[i], dim=1))
-        q_pred = torch.cat(q_pred, 0)
-        q_loss = quantile_loss(target, q_pred, quantiles[i], eval_points)
-        CRPS += q_loss / denom
-    return CRPS.item() / len(quantiles)
+        q_loss[i] = quantile_loss(target, q_pred[i], quantiles[i], eval_points)
+    return q_loss
+
 
-def calc_quantile_CRPS_sum(target, forecast, eval_points, mean_scaler, scaler):
+def calc_quantile_CRPS_terms(
+    target, forecast, eval_points, mean_scaler, scaler, chunk_size=64
+):
+    # per-quantile loss sums and the denominator; these add up across batches
+    quantiles = np.arange(0.05, 1.0, 0.05)
+    q_loss = 0
+    denom = 0
+    # chunk over the batch axis so the sort never holds more than chunk_size series
+    for start in range(0, len(forecast), chunk_size):
+        end = start + chunk_size
+        target_chunk = target[start:end] * scaler + mean_scaler
+        forecast_chunk = forecast[start:end] * scaler + mean_scaler
+        q_loss += calc_quantile_losses(
+            target_chunk, forecast_chunk, eval_points[start:end], quantiles
+        )
+        denom += calc_denominator(target_chunk, eval_points[start:end])
+    return q_loss, denom
 
-    eval_points = eval_points.mean(-1)
-    target = target * scaler + mean_scaler
-    target = target.sum(-1)
-    forecast = forecast * scaler + mean_scaler
 
+def calc_quantile_CRPS_sum_terms(
+    target, forecast, eval_points, mean_scaler, scaler, chunk_size=64
+):
     quantiles = np.arange(0.05, 1.0, 0.05)
-    denom = calc_denominator(target, eval_points)
-    CRPS = 0
-    for i in range(len(quantiles)):
-        q_pred = torch.quantile(forecast.sum(-1),quantiles[i],dim=1)
-        q_loss = quantile_loss(target, q_pred, quantiles[i], eval_points)
-        CRPS += q_loss / denom
-    return CRPS.item() / len(quantiles)
+    q_loss = 0
+    denom = 0
+    for start in range(0, len(forecast), chunk_size):
+        end = start + chunk_size
+        eval_chunk = eval_points[start:end].mean(-1)
+        target_chunk = (target[start:end] * scaler + mean_scaler).sum(-1)
+        forecast_chunk = (forecast[start:end] * scaler + mean_scaler).sum(-1)
+        q_loss += calc_quantile_losses(
+            target_chunk, forecast_chunk, eval_chunk, quantiles
+        )
+        denom += calc_denominator(target_chunk, eval_chunk)
+    return q_loss, denom
+
 
-def evaluate(model, test_loader, nsample=100, scaler=1, mean_scaler=0, foldername=""):
+def calc_CRPS_from_terms(q_loss, denom):
+    return torch.sum(q_loss / denom).item() / len(q_loss)
+
+
+def calc_quantile_CRPS(
+    target, forecast, eval_points, mean_scaler, scaler, chunk_size=64
+):
+    return calc_CRPS_from_terms(
+        *calc_quantile_CRPS_terms(
+            target, forecast, eval_points, mean_scaler, scaler, chunk_size
+        )
+    )
+
+def calc_quantile_CRPS_sum(
+    target, forecast, eval_points, mean_scaler, scaler, chunk_size=64
+):
+    return calc_CRPS_from_terms(
+        *calc_quantile_CRPS_sum_terms(
+            target, forecast, eval_points, mean_scaler, scaler, chunk_size
+        )
+    )
+
+def get_autocast(precision, device):
+    # reduced precision only for the denoiser; callers cast results back to fp32
+    if precision == "fp32":
+        return contextlib.nullcontext()
+    dtypes = {"bf16": torch.bfloat16, "fp16": torch.float16}
+    if precision not in dtypes:
+        raise ValueError("unknown precision: " + str(precision))
+    return torch.autocast(
+        device_type=torch.device(device).type, dtype=dtypes[precision]
+    )
 
-    with torch.no_grad():
+
+def merge_eval_partials(partials):
+    # per-batch metric sums added in batch order, exactly as one process would
+    totals = {
+        "mse": 0,
+        "mae": 0,
+        "evalpoints": 0,
+        "crps_loss": 0,
+        "crps_denom": 0,
+        "crps_sum_loss": 0,
+        "crps_sum_denom": 0,
+    }
+    for partial in sorted(partials, key=lambda p: p["batch_no"]):
+        for key in totals:
+            totals[key] += partial[key]
+    return totals
+
+
+def evaluate(
+    model,
+    test_loader,
+    nsample=100,
+    scaler=1,
+    mean_scaler=0,
+    foldername="",
+    save_samples=False,
+    precision="fp32",
+    seed=None,
+    ema=None,
+):
+    # metrics are accumulated per batch; raw samples are only written when
+    # save_samples is set, streamed batch by batch to a SampleWriter folder.
+    # Under torch.distributed each rank loads and samples every world_size-th
+    # batch and writes its own sample shard; rank 0 gathers the per-batch sums
+    # and merges them in batch order. With seed set, every batch is sampled with
+    # seed + batch_no, so the merged result matches a single process bit for bit.
+    # With ema given, sampling uses the EMA weights
+
+    rank = get_rank()
+    num_shards = dist.get_world_size() if is_distributed() else 1
+    # frozen TorchScript models (frozen_denoiser.FrozenImputer) have no parameters
+    device = getattr(model, "device", None) or next(model.parameters()).device
+    if num_shards > 1:
+        test_loader = shard_batches(test_loader, rank, num_shards)
+    batch_numbers = get_batch_numbers(test_loader)
+    with torch.no_grad(), ema.swap() if ema else contextlib.nullcontext():
         model.eval()
         mse_total = 0
         mae_total = 0
         evalpoints_total = 0
+        partials = []
 
-        all_target = []
-        all_observed_point = []
-        all_observed_time = []
-        all_evalpoint = []
-        all_generated_samples = []
-        with tqdm(test_loader, mininterval=5.0, maxinterval=50.0) as it:
-            for batch_no, test_batch in enumerate(it, start=1):
-                output = model.evaluate(test_batch, nsample)
+        if save_samples:
+            output_folder = foldername + "/generated_outputs_nsample" + str(nsample)
+            if num_shards > 1:
+                output_folder += "_shard" + str(rank)
+            writer = SampleWriter(
+                output_folder, scaler=scaler, mean_scaler=mean_scaler
+            )
+        with tqdm(
+            test_loader, mininterval=5.0, maxinterval=50.0, disable=rank != 0
+        ) as it:
+            for batch_no, test_batch in zip(batch_numbers, instrument.timed_iter(it)):
+                if seed is not None:
+                    torch.manual_seed(seed + batch_no)
+                with instrument.timer("sample"), get_autocast(precision, device):
+                    output = model.evaluate(test_batch, nsample)
 
                 samples, c_target, eval_points, observed_points, observed_time = output
+                samples = samples.float()
                 samples = samples.permute(0, 1, 3, 2)  # (B,nsample,L,K)
                 c_target = c_target.permute(0, 2, 1)  # (B,L,K)
                 eval_points = eval_points.permute(0, 2, 1)
                 observed_points = observed_points.permute(0, 2, 1)
 
-                samples_median = samples.median(dim=1)
-                all_target.append(c_target)
-                all_evalpoint.append(eval_points)
-                all_observed_point.append(observed_points)
-                all_observed_time.append(observed_time)
-                all_generated_samples.append(samples)
+                with instrument.timer("median"):
+                    samples_median = samples.median(dim=1)
+                if save_samples:
+                    with instrument.timer("serialization"):
+                        writer.write(
+                            samples, c_target, eval_points, observed_points, observed_time
+                        )
 
                 mse_current = (
                     ((samples_median.values - c_target) * eval_points) ** 2
@@ -154,9 +572,31 @@ def evaluate(model, test_loader, nsample=100, scaler=1, mean_scaler=0, foldernam
                     torch.abs((samples_median.values - c_target) * eval_points) 
                 ) * scaler
 
-                mse_total += mse_current.sum().item()
-                mae_total += mae_current.sum().item()
-                evalpoints_total += eval_points.sum().item()
+                with instrument.timer("crps"):
+                    crps_loss, crps_denom = calc_quantile_CRPS_terms(
+                        c_target, samples, eval_points, mean_scaler, scaler
+                    )
+                    crps_sum_loss, crps_sum_denom = calc_quantile_CRPS_sum_terms(
+                        c_target, samples, eval_points, mean_scaler, scaler
+                    )
+                partial = {
+                    "batch_no": batch_no,
+                    "mse": mse_current.sum().item(),
+                    "mae": mae_current.sum().item(),
+                    "evalpoints": eval_points.sum().item(),
+                    "crps_loss": crps_loss.cpu(),
+                    "crps_denom": crps_denom.cpu(),
+                    "crps_sum_loss": crps_sum_loss.cpu(),
+                    "crps_sum_denom": crps_sum_denom.cpu(),
+                }
+                partials.append(partial)
+
+                mse_total += partial["mse"]
+                mae_total += partial["mae"]
+                evalpoints_total += partial["evalpoints"]
+                instrument.count("eval_batches")
+                instrument.count("eval_samples", samples.shape[0] * samples.shape[1])
+                instrument.step()
 
                 it.set_postfix(
                     ordered_dict={
@@ -167,33 +607,25 @@ def evaluate(model, test_loader, nsample=100, scaler=1, mean_scaler=0, foldernam
                     refresh=True,
                 )
 
-            with open(
-                foldername + "/generated_outputs_nsample" + str(nsample) + ".pk", "wb"
-            ) as f:
-                all_target = torch.cat(all_target, dim=0)
-                all_evalpoint = torch.cat(all_evalpoint, dim=0)
-                all_observed_point = torch.cat(all_observed_point, dim=0)
-                all_observed_time = torch.cat(all_observed_time, dim=0)
-                all_generated_samples = torch.cat(all_generated_samples, dim=0)
+            if save_samples:
+                with instrument.timer("serialization"):
+                    writer.close()
+            instrument.flush(phase="evaluate")
 
-                pickle.dump(
-                    [
-                        all_generated_samples,
-                        all_target,
-                        all_evalpoint,
-                        all_observed_point,
-                        all_observed_time,
-                        scaler,
-                        mean_scaler,
-                    ],
-                    f,
-                )
+            if is_distributed():
+                gathered = [None] * num_shards if rank == 0 else None
+                dist.gather_object(partials, gathered, dst=0)
+                if rank != 0:
+                    return
+                partials = [partial for shard in gathered for partial in shard]
+            totals = merge_eval_partials(partials)
+            mse_total = totals["mse"]
+            mae_total = totals["mae"]
+            evalpoints_total = totals["evalpoints"]
 
-            CRPS = calc_quantile_CRPS(
-                all_target, all_generated_samples, all_evalpoint, mean_scaler, scaler
-            )
-            CRPS_sum = calc_quantile_CRPS_sum(
-                all_target, all_generated_samples, all_evalpoint, mean_scaler, scaler
+            CRPS = calc_CRPS_from_terms(totals["crps_loss"], totals["crps_denom"])
+            CRPS_sum = calc_CRPS_from_terms(
+                totals["crps_sum_loss"], totals["crps_sum_denom"]
             )
 
             with open(
@@ -0,0 +1,151 @@
+import pickle
+
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+# fixed-length windows over a (T,K) series that is stored once; a window is a
+# start offset and is read as a zero-copy view series[start:start + length].
+# Windows never cross a segment boundary (e.g. a month), and month or
+# validation filters select from the starts, so memory is
+# O(T x K) for the series plus O(windows) for the index.
+
+
+class WindowIndex:
+    def __init__(self, segment_ids, length, stride=1, cover_tail=False):
+        # segment_ids: (T,) label of every time step, equal labels contiguous.
+        # stride=length with cover_tail tiles each segment once, the last
+        # window shifted back and its overlap reported in cut_length
+        segment_ids = np.asarray(segment_ids)
+        bounds = np.flatnonzero(np.diff(segment_ids)) + 1
+        seg_starts = np.concatenate([[0], bounds])
+        seg_ends = np.concatenate([bounds, [len(segment_ids)]])
+        starts, cut_length = [], []
+        for begin, end in zip(seg_starts, seg_ends):
+            if end - begin < length:
+                continue
+            seg = np.arange(begin, end - length + 1, stride)
+            cut = np.zeros(len(seg), dtype=np.int64)
+            if cover_tail and (end - begin) % length != 0:
+                seg = np.append(seg, end - length)
+                cut = np.append(cut, length - (end - begin) % length)
+            starts.append(seg)
+            cut_length.append(cut)
+        self.length = length
+        self.starts = np.concatenate(starts).astype(np.int64)
+        self.cut_length = np.concatenate(cut_length)
+        self.segment = segment_ids[self.starts]
+
+    def select(self, keep):
+        # sub-index of the windows in keep (a boolean mask or indices)
+        index = object.__new__(WindowIndex)
+        index.length = self.length
+        index.starts = self.starts[keep]
+        index.cut_length = self.cut_length[keep]
+        index.segment = self.segment[keep]
+        return index
+
+    def isin(self, segments):
+        return np.isin(self.segment, segments)
+
+    def ordered(self, segments):
+        # indices of the windows of the given segments, grouped in that order
+        return np.concatenate([np.flatnonzero(self.segment == s) for s in segments])
+
+    def window(self, series, i):
+        start = self.starts[i]
+        return series[start : start + self.length]
+
+    def __len__(self):
+        return len(self.starts)
+
+
+def load_pm25_series(folder="./data/pm25"):
+    # normalized ground-truth series (T,36), its observed mask, the mask of the
+    # values left after removing the missing pattern, and the month of each step
+    df = pd.read_csv(
+        folder + "/Code/STMVL/SampleData/pm25_ground.txt",
+        index_col="datetime",
+        parse_dates=True,
+    )
+    df_gt = pd.read_csv(
+        folder + "/Code/STMVL/SampleData/pm25_missing.txt",
+        index_col="datetime",
+        parse_dates=True,
+    )
+    with open(folder + "/pm25_meanstd.pk", "rb") as f:
+        train_mean, train_std = pickle.load(f)
+    observed_mask = np.ascontiguousarray(1 - df.isnull().values, dtype=np.float32)
+    gt_mask = np.ascontiguousarray(1 - df_gt.isnull().values, dtype=np.float32)
+    observed_data = ((df.fillna(0).values - train_mean) / train_std) * observed_mask
+    series = {
+        "observed_data": np.ascontiguousarray(observed_data, dtype=np.float32),
+        "observed_mask": observed_mask,
+        "gt_mask": gt_mask,
+    }
+    return series, df.index.month.values, train_mean, train_std
+
+
+class PM25_Window_Dataset(Dataset):
+    def __init__(self, series, months, eval_length=36, mode="train", validindex=0):
+        month_list = [1, 2, 4, 5, 7, 8, 10, 11]
+        # 1st,4th,7th,10th months are excluded from histmask (their masks are
+        # used for creating the missing patterns of the test dataset)
+        hist_months = [2, 5, 8, 11]
+        if mode == "train":
+            month_list.pop(validindex)
+        elif mode == "valid":
+            month_list = month_list[validindex : validindex + 1]
+        else:
+            month_list = [3, 6, 9, 12]
+
+        self.series = series
+        self.eval_length = eval_length
+        self.timepoints = np.arange(eval_length)
+        windows = WindowIndex(
+            months, eval_length, stride=eval_length if mode == "test" else 1,
+            cover_tail=mode == "test",
+        )
+        self.windows = windows.select(windows.ordered(month_list))
+
+        # histmask of the i-th window: the observed mask of the i-th (cyclic)
+        # window from a histmask month
+        self.hist_starts = self.windows.starts
+        if mode == "train":
+            hist = np.flatnonzero(self.windows.isin(hist_months))
+            order = np.arange(len(self.windows)) % len(hist)
+            self.hist_starts = self.windows.starts[hist[order]]
+
+    def __getitem__(self, org_index):
+        hist_start = self.hist_starts[org_index]
+        s = {
+            "observed_data": self.windows.window(self.series["observed_data"], org_index),
+            "observed_mask": self.windows.window(self.series["observed_mask"], org_index),
+            "gt_mask": self.windows.window(self.series["gt_mask"], org_index),
+            "hist_mask": self.series["observed_mask"][
+                hist_start : hist_start + self.eval_length
+            ],
+            "timepoints": self.timepoints,
+            "cut_length": self.windows.cut_length[org_index],
+        }
+        return s
+
+    def __len__(self):
+        return len(self.windows)
+
+
+def get_dataloader(batch_size, device, validindex=0, folder="./data/pm25"):
+    series, months, train_mean, train_std = load_pm25_series(folder)
+
+    dataset = PM25_Window_Dataset(series, months, mode="train", validindex=validindex)
+    train_loader = DataLoader(dataset, batch_size=batch_size, num_workers=1, shuffle=True)
+    dataset_test = PM25_Window_Dataset(series, months, mode="test", validindex=validindex)
+    test_loader = DataLoader(dataset_test, batch_size=batch_size, num_workers=1, shuffle=False)
+    dataset_valid = PM25_Window_Dataset(series, months, mode="valid", validindex=validindex)
+    valid_loader = DataLoader(dataset_valid, batch_size=batch_size, num_workers=1, shuffle=False)
+
+    scaler = torch.from_numpy(train_std).to(device).float()
+    mean_scaler = torch.from_numpy(train_mean).to(device).float()
+
+    return train_loader, valid_loader, test_loader, scaler, mean_scaler